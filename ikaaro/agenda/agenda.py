@@ -19,23 +19,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from Standard Library
+from cStringIO import StringIO
 from datetime import time
+from traceback import format_exc
 
 # Import from itools
 from itools.csv import Property, property_to_str
 from itools.csv.table import get_tokens, read_name, unfold_lines
+from itools.database import AndQuery, PhraseQuery
 from itools.datatypes import String
 from itools.gettext import MSG
 from itools.ical import iCalendar
+from itools.log import log_error
+from itools.web import get_context
 
 # Import from ikaaro
 from ikaaro.config_common import NewResource_Local
 from ikaaro.fields import Char_Field
 from ikaaro.folder import Folder
+from ikaaro.utils import get_base_path_query
 from agenda_views import Calendar_Export, Calendar_ExportForm
 from agenda_views import Calendar_Import, TimetablesForm
 from agenda_views import MonthlyView, WeeklyView, DailyView
-from agenda_views import Calendar_NewEvent
+from agenda_views import Calendar_NewEvent, ICalendarImportError
 from calendars import Calendar, Calendars_View
 from event import Event
 
@@ -53,6 +59,50 @@ ikaaro_to_ics = [
 ics_to_ikaaro = dict([(y, x) for x, y in ikaaro_to_ics])
 
 
+def iter_ical_batches(file, size):
+    """Read the given iCalendar file one line at a time, and split it in a
+    sequence of smaller iCalendar files of at most 'size' events each.  The
+    calendar properties and time zones are repeated in every batch.
+    """
+    head = []
+    batch = []
+    n = 0
+    component = None
+    lines = []
+    for line in file:
+        name = line.rstrip('\r\n')
+        # Calendar properties
+        if component is None:
+            if name == 'END:VCALENDAR':
+                break
+            elif name.startswith('BEGIN:') and name != 'BEGIN:VCALENDAR':
+                component = name[6:]
+                lines = [line]
+            else:
+                head.append(line)
+            continue
+
+        # Components (VTIMEZONE, VEVENT, ...)
+        lines.append(line)
+        if name != 'END:%s' % component:
+            continue
+        if component == 'VTIMEZONE':
+            head.extend(lines)
+        elif component == 'VEVENT':
+            batch.extend(lines)
+            n += 1
+        component = None
+        lines = []
+        # Next batch
+        if n == size:
+            yield ''.join(head + batch + ['END:VCALENDAR\n'])
+            batch = []
+            n = 0
+
+    if n:
+        yield ''.join(head + batch + ['END:VCALENDAR\n'])
+
+
 class Timetables(String):
     """Timetables are tuples of time objects (start, end) used by cms.ical.
 
@@ -125,6 +175,10 @@ class ConfigAgenda(Folder):
         (time(19,0), time(20,0)),
         (time(20,0), time(21,0))]
 
+    # Number of events serialized or loaded at once by the iCalendar
+    # export and import
+    ical_batch_size = 500
+
 
     def init_resource(self, **kw):
         super(ConfigAgenda, self).init_resource(**kw)
@@ -158,14 +212,25 @@ class ConfigAgenda(Folder):
     def to_ical(self, context):
         """Serialize as an ical file, generally named .ics
         """
+        return ''.join(self.iter_ical(context))
+
 
-        lines = ['BEGIN:VCALENDAR\n',
-                'VERSION:2.0\n',
-                'PRODID:-//itaapy.com/NONSGML ikaaro icalendar V1.0//EN\n']
+    def iter_ical(self, context):
+        """Serialize as an ical file, one event at a time.  The events are
+        taken from the catalog, and loaded resources are released as we go.
+        """
+        yield ('BEGIN:VCALENDAR\n'
+               'VERSION:2.0\n'
+               'PRODID:-//itaapy.com/NONSGML ikaaro icalendar V1.0//EN\n')
 
         # Calendar components
-        for event in self.search_resources(cls=Event):
-            lines.append('BEGIN:VEVENT\n')
+        database = context.database
+        query = AndQuery(get_base_path_query(self.abspath, max_depth=1),
+                         PhraseQuery('base_classes', 'event'))
+        search = database.search(query)
+        for i, brain in enumerate(search.get_documents(sort_by='abspath')):
+            event = database.get_resource(brain.abspath)
+            lines = ['BEGIN:VEVENT\n']
             for ikaaro_name, ics_name in ikaaro_to_ics:
                 property = event.get_property(ikaaro_name)
                 lang = property.get_parameter('lang')
@@ -177,11 +242,13 @@ class ConfigAgenda(Folder):
                 datatype = event.get_field(ikaaro_name).datatype
                 line = property_to_str(ics_name, property, datatype, p_schema)
                 lines.append(line)
-
             lines.append('END:VEVENT\n')
-        lines.append('END:VCALENDAR\n')
+            yield ''.join(lines)
+            # Free memory
+            if i % self.ical_batch_size == self.ical_batch_size - 1:
+                database.make_room()
 
-        return ''.join(lines)
+        yield 'END:VCALENDAR\n'
 
 
     def parse_ical(self, data):
@@ -209,28 +276,59 @@ class ConfigAgenda(Folder):
                 yield name, value, parameters
 
 
+    def iter_ical_events(self, file):
+        """Parse the given iCalendar file by batches of 'ical_batch_size'
+        events, yield the properties of every event.
+        """
+        for data in iter_ical_batches(file, self.ical_batch_size):
+            ical = iCalendar()
+            ical.reset()
+            ical._load_state_from_file(StringIO(data))
+            for event in ical.get_components('VEVENT'):
+                properties = {}
+                for name, value in event.get_property().items():
+                    if name in ics_to_ikaaro:
+                        name = ics_to_ikaaro[name]
+                        properties[name] = value.value
+                properties['uid'] = event.uid
+                yield properties
+
+
     def load_state_from_ical_file(self, file):
-        # Clear Calendar
-        for event in self._get_names():
-            self.del_resource(event)
+        """Replace the events by the ones of the given iCalendar file.  The
+        file is read and loaded by batches of 'ical_batch_size' events, to
+        keep the memory bounded, in the current transaction.
+
+        The file is parsed once before anything changes, so an error in the
+        file changes nothing.  If loading an event fails, the changes are
+        aborted (the calendar is left as it was) and ICalendarImportError
+        is raised.
+        """
+        database = get_context().database
 
-        ical = iCalendar()
-        ical.reset()
-        ical._load_state_from_file(file)
-        timezones = ical.get_components('VTIMEZONE')
-        events = ical.get_components('VEVENT')
+        # Check the file
+        for properties in self.iter_ical_events(file):
+            pass
+        file.seek(0)
 
         i = 0
-        for event in events:
-            filename = str(i)
-            properties = {}
-            for name, value in event.get_property().items():
-                if name in ics_to_ikaaro:
-                    name = ics_to_ikaaro[name]
-                    properties[name] = value.value
-            properties['uid'] = event.uid
-            self.make_resource(filename, Event, **properties)
-            i += 1
+        try:
+            # Clear Calendar
+            for event in self._get_names():
+                self.del_resource(event)
+            # Load the events, free memory after every batch
+            for properties in self.iter_ical_events(file):
+                self.make_resource(str(i), Event, **properties)
+                i += 1
+                if i % self.ical_batch_size == 0:
+                    database.make_room()
+        except Exception:
+            log_error('iCalendar import error\n' + format_exc())
+            database.abort_changes()
+            raise ICalendarImportError
+
+        return i
+
 
     # Views
     monthly_view = MonthlyView
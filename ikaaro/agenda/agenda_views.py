@@ -27,9 +27,9 @@ from itools.core import proto_lazy_property, proto_property
 from itools.datatypes import Date, Integer
 from itools.gettext import MSG
 from itools.ical import Time
-from itools.database import AndQuery, PhraseQuery, NotQuery
+from itools.database import AndQuery, PhraseQuery, NotQuery, RangeQuery
 from itools.stl import stl
-from itools.web import BaseView, STLView, INFO, ERROR, get_context
+from itools.web import BaseView, STLView, INFO, ERROR
 
 # Import from ikaaro
 from calendars import Calendars_Enumerate
@@ -59,6 +59,13 @@ months = {
     11: MSG(u'November'),
     12: MSG(u'December')}
 
+class ICalendarImportError(StandardError):
+    """Loading the events of an iCalendar file failed, the changes have
+    been aborted (see ConfigAgenda.load_state_from_ical_file).
+    """
+
+
+
 ######################################################################
 # Calendar timetables configuration
 ######################################################################
@@ -381,24 +388,56 @@ class CalendarView(STLView):
     ######################################################################
     # Public API
     ######################################################################
-    def get_events(self, day=None, *args):
+    @proto_lazy_property
+    def hidden_calendars(self):
+        """The calendars the current user has chosen to hide, computed once
+        per request.
+        """
+        context = self.context
+        username = context.user.name
+        calendars = context.search(format='calendar').get_resources()
+        return [ str(x.abspath) for x in calendars
+                 if username in x.get_value('hidden_for_users') ]
+
+
+    def get_events_query(self, *args):
         query = AndQuery(*args)
         query.append(PhraseQuery('base_classes', 'event'))
-        if day:
-            query.append(PhraseQuery('dates', day))
-
         # Do not show hidden calendars
-        context = get_context()
-        for calendar in context.search(format='calendar').get_resources():
-            if context.user.name in calendar.get_value('hidden_for_users'):
-                abspath = str(calendar.abspath)
-                query.append(NotQuery(PhraseQuery('calendar', abspath)))
+        for abspath in self.hidden_calendars:
+            query.append(NotQuery(PhraseQuery('calendar', abspath)))
+        return query
+
+
+    def get_events(self, day=None, *args):
+        if day:
+            return self.get_events_by_day(day, 1, *args)[day]
 
         # Ok
+        query = self.get_events_query(*args)
         search = self.context.search(query)
         return search.get_resources(sort_by='dtstart')
 
 
+    def get_events_by_day(self, start, ndays, *args):
+        """Return a dict {day: [event, ...]} with the events occurring in
+        the ndays starting at the given date, sorted by dtstart.  A single
+        search is made for the whole window, then the recurrences of the
+        events found are expanded within the window only.
+        """
+        end = start + timedelta(ndays - 1)
+        query = self.get_events_query(*args)
+        query.append(RangeQuery('dates_start', None, end))
+        query.append(RangeQuery('dates_end', start, None))
+        search = self.context.search(query)
+
+        events = dict([ (start + timedelta(x), []) for x in range(ndays) ])
+        for event in search.get_resources(sort_by='dtstart'):
+            for day in event.get_dates(start, end):
+                events[day].append(event)
+        return events
+
+
     def get_namespace(self, resource, context):
         c_date = self.get_current_date(context)
         cal_selector = self.calendar_selector(context=context, c_date=c_date)
@@ -457,6 +496,7 @@ class MultiweekView(CalendarView):
         # Get the 5 weeks
         namespace['weeks'] = []
         link = ';new_event?dtstart={date}&dtend={date}'
+        events = self.get_events_by_day(start, nweeks * 7)
         day = start
         for kk in range(nweeks):
             ns_week = []
@@ -475,7 +515,7 @@ class MultiweekView(CalendarView):
                     if with_new_url:
                         ns_day['url'] = link.format(date=Date.encode(day))
                     # Get a list of events to display on view
-                    for event in self.get_events(day):
+                    for event in events[day]:
                         ns_day['events'].append(
                           {'stream': event.render(event=event, day=day),
                            'color': event.get_color(),
@@ -550,10 +590,12 @@ class WeeklyView(CalendarView):
             headers = [None] * ndays
 
         # Get a list of events to display on view
+        events = self.get_events_by_day(current_date,
+                                        (len(headers) - 1) * step.days + 1)
         for header in headers:
             # Insert events
             ns_events = []
-            for event in self.get_events(current_date):
+            for event in events[current_date]:
                 n = event.get_ns_event(current_date, grid=True)
                 n['stream'] = event.render(event=event, day=current_date)
                 ns_events.append(n)
@@ -636,6 +678,10 @@ class Calendar_Import(STLView):
         # Replace
         try:
             resource.load_state_from_ical_file(StringIO(body))
+        except ICalendarImportError:
+            message = ERROR(u'Failed to load the file, the calendar has not '
+                            u'been changed.')
+            context.message = message
         except BaseException:
             message = ERROR(u'Failed to load the file, may contain errors.')
             context.message = message
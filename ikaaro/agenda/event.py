@@ -44,7 +44,7 @@ from ikaaro import messages
 # Import from calendar
 from calendars import Calendars_Enumerate
 from recurrence import RRule_Field, RRuleInterval_Field, RRuleUntil_Field
-from recurrence import get_dates
+from recurrence import get_dates, get_until
 from reminders import Reminder_Field
 
 
@@ -359,7 +359,11 @@ class Event(Content):
             self.set_value('uid', uid)
 
 
-    def get_dates(self):
+    def get_dates_range(self):
+        """Return the first and last days covered by the event, taking the
+        recurrence into account.  The last day is date.max if the recurrence
+        is unbounded.
+        """
         start = self.get_value('dtstart')
         if type(start) is datetime:
             start = start.date()
@@ -370,7 +374,29 @@ class Event(Content):
 
         # Recurrence
         rrule = self.metadata.get_property('rrule')
-        dates = get_dates(start, end, rrule)
+        if rrule and rrule.value:
+            until = get_until(rrule)
+            if until is None:
+                return start, date.max
+            end = until + (end - start)
+        return start, end
+
+
+    def get_dates(self, first, last):
+        """Return the days, between first and last (both included), the
+        event occurs.  The recurrence is only expanded inside that window.
+        """
+        start = self.get_value('dtstart')
+        if type(start) is datetime:
+            start = start.date()
+
+        end = self.get_value('dtend')
+        if type(end) is datetime:
+            end = end.date()
+
+        # Recurrence
+        rrule = self.metadata.get_property('rrule')
+        dates = set(get_dates(start, end, rrule, first, last))
         # Exclude dates
         exdate = self.get_value('exdate')
         dates.difference_update(exdate)
@@ -396,7 +422,7 @@ class Event(Content):
 
     def get_catalog_values(self):
         values = super(Event, self).get_catalog_values()
-        values['dates'] = self.get_dates()
+        values['dates_start'], values['dates_end'] = self.get_dates_range()
         return values
 
 
@@ -530,4 +556,5 @@ class EventModel(Model):
 
 
 # Register
-register_field('dates', Date(indexed=True, multiple=True))
+register_field('dates_start', Date(indexed=True, stored=True))
+register_field('dates_end', Date(indexed=True, stored=True))
@@ -32,9 +32,6 @@ from ikaaro.utils import make_stl_template
 ###########################################################################
 # Code to calculate the dates
 ###########################################################################
-# Recurrence
-MAX_DELTA = timedelta(3650) # we cannot index an infinite number of values
-
 def next_day(x, delta=timedelta(1)):
     return x + delta
 
@@ -62,15 +59,23 @@ rrules = {
     'yearly': next_year}
 
 
-def get_dates(start, end, rrule):
-    dates = set()
-    days = range((end - start).days + 1)
-    f = lambda date: dates.update([ date + timedelta(x) for x in days ])
+def get_until(rrule):
+    """Return the last day an occurrence may start, or None if the
+    recurrence is unbounded.
+    """
+    if not rrule or not rrule.value:
+        return None
+    return rrule.get_parameter('until')
+
 
+def get_occurrences(start, rrule):
+    """Generate, lazily and in order, the first day of every occurrence.
+    The generator does not end if the recurrence has no 'until' parameter.
+    """
     # Case 1: No recurrence rule
     if not rrule or not rrule.value:
-        f(start)
-        return dates
+        yield start
+        return
 
     # Case 2: Recurrence rule
     rrule_name = rrule.value
@@ -81,13 +86,8 @@ def get_dates(start, end, rrule):
                    for v in bydays ]
 
     until = rrule.get_parameter('until')
-    if until:
-        until += timedelta(1)
-    else:
-        until = max(start, date.today()) + MAX_DELTA
-
     next_date = rrules[rrule_name]
-    while start < until:
+    while until is None or start <= until:
         interval = rrule_interval
         if bydays:
             # Check any day of byday parameter
@@ -98,18 +98,32 @@ def get_dates(start, end, rrule):
                 # Go ahead to current byday value
                 while start.isoweekday() < byday:
                     start = next_day(start)
-                if start >= until:
-                    break
-                # Add current day (== byday value)
-                f(start)
+                if until is not None and start > until:
+                    return
+                # Current day (== byday value)
+                yield start
         else:
-            f(start)
+            yield start
         # Go to next date based on rrule value and interval
         while interval > 0:
             start = next_date(start)
             interval -= 1
 
-    return dates
+
+def get_dates(start, end, rrule, first, last):
+    """Generate the days covered by the occurrences of the event going from
+    'start' to 'end', limited to the window going from 'first' to 'last'
+    (both included).  A day may be generated more than once if occurrences
+    overlap.
+    """
+    duration = (end - start).days
+    for x in get_occurrences(start, rrule):
+        if x > last:
+            return
+        for i in range(duration + 1):
+            day = x + timedelta(i)
+            if first <= day <= last:
+                yield day
 
 
 
@@ -24,6 +24,7 @@ from views import ApiDevPanel_ResourceJSON, ApiDevPanel_ResourceRaw, ApiDevPanel
 from views import ApiDevPanel_ClassidViewDetails, ApiDevPanel_ClassidViewList
 from views import ApiDevPanel_Config, ApiDevPanel_Log
 from views import ApiDevPanel_CatalogReindex, UUIDView
+from views import ApiDevPanel_BrokenLinks
 from views import ApiDevPanel_ServerView, ApiDevPanel_ServerStop
 
 
@@ -46,6 +47,8 @@ urlpatterns = [
     urlpattern('/devpanel/log/update', ApiDevPanel_Log(source_name='update')),
     # Catalog
     urlpattern('/devpanel/catalog/reindex', ApiDevPanel_CatalogReindex),
+    # Links
+    urlpattern('/devpanel/links/broken', ApiDevPanel_BrokenLinks),
     # Server
     urlpattern('/devpanel/server', ApiDevPanel_ServerView),
     urlpattern('/devpanel/server/stop', ApiDevPanel_ServerStop),
@@ -24,7 +24,9 @@ from itools.web.exceptions import NotFound, Forbidden, Unauthorized
 from itools.web.views import ItoolsView
 
 # Import from ikaaro
-from ikaaro.fields import Boolean_Field, Char_Field, Integer_Field
+from ikaaro.database import get_links_index
+from ikaaro.fields import Boolean_Field, Char_Field, Decimal_Field
+from ikaaro.fields import Integer_Field
 from ikaaro.fields import Email_Field, Password_Field, Datetime_Field
 from ikaaro.server import get_config
 from ikaaro.utils import get_resource_by_uuid_query
@@ -299,6 +301,29 @@ class ApiDevPanel_CatalogReindex(Api_View):
 
 
 
+class ApiDevPanel_BrokenLinks(Api_View):
+    """ List the broken links: the resources linking to resources that do
+    not exist
+    """
+
+    access = 'is_admin'
+    known_methods = ['GET']
+    response_schema = {
+        'total': Integer_Field(title=MSG(u'Number of broken links')),
+        'items': Char_Field(title=MSG(u'Resources with broken links'))
+    }
+
+    def GET(self, root, context):
+        links_index = get_links_index(context.database)
+        broken = links_index.get_broken_links()
+        items = [ {'path': path, 'links': broken[path]}
+                  for path in sorted(broken) ]
+        kw = {'total': sum([ len(x['links']) for x in items ]),
+              'items': items}
+        return self.return_json(kw, context)
+
+
+
 class ApiDevPanel_ServerView(Api_View):
     """ Return informations about server timestamp / pid / port
     """
@@ -308,7 +333,13 @@ class ApiDevPanel_ServerView(Api_View):
     response_schema = {
         'timestamp': Char_Field(title=MSG(u"Server's start timestamp")),
         'pid': Integer_Field(title=MSG(u"Server's PID")),
-        'port': Integer_Field(title=MSG(u"Server's port"))
+        'port': Integer_Field(title=MSG(u"Server's port")),
+        'spool_queued': Integer_Field(title=MSG(u"Emails waiting")),
+        'spool_sent': Integer_Field(title=MSG(u"Emails sent")),
+        'spool_failed': Integer_Field(title=MSG(u"Emails refused")),
+        'spool_errors': Integer_Field(title=MSG(u"Errors sending emails")),
+        'spool_rate': Decimal_Field(title=MSG(u"Emails sent per second")),
+        'spool_worker': Integer_Field(title=MSG(u"Mail worker's PID")),
     }
 
     def GET(self, root, context):
@@ -316,6 +347,11 @@ class ApiDevPanel_ServerView(Api_View):
         kw = {'timestamp': server.timestamp,
               'pid': getpid(),
               'port': server.port}
+        # The mail spool
+        stats = server.get_spool_stats()
+        for name in ['queued', 'sent', 'failed', 'errors', 'rate']:
+            kw['spool_%s' % name] = stats[name]
+        kw['spool_worker'] = stats.get('pid')
         return self.return_json(kw, context)
 
 
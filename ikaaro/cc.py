@@ -15,14 +15,20 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
+from datetime import timedelta
 from operator import itemgetter
+from traceback import format_exc
 
 # Import from itools
 from itools.core import freeze, proto_property
 from itools.database import Resource, MetadataProperty
+from itools.database import AndQuery, OrQuery, PhraseQuery
 from itools.datatypes import Email, Enumerate, MultiLinesTokens
 from itools.datatypes import String
 from itools.gettext import MSG
+from itools.log import log_error
+from itools.loop import cron
+from itools.uri import encode_query
 from itools.web import get_context, INFO, ERROR
 
 # Import from ikaaro
@@ -54,6 +60,12 @@ MSG_INVITED = INFO(u'The following users have been invited: {users}.',
         format='replace_html')
 MSG_UNALLOWED = ERROR(u'The following users are prevented from subscribing: '
         u'{users}.', format='replace_html')
+MSG_MASS_SUBSCRIPTION = INFO(u'The invitations are being sent, {done} of '
+        u'{total} addresses processed.')
+MSG_MASS_SUBSCRIPTION_RUNNING = ERROR(u'Invitations are already being sent, '
+        u'wait for them to be sent.')
+MSG_MASS_SUBSCRIPTION_FAILED = ERROR(u'Sending the invitations failed, '
+        u'{done} of {total} addresses processed.')
 
 
 def add_subscribed_message(message, users, context, users_is_resources=True):
@@ -281,51 +293,45 @@ class MassSubscriptionForm(AutoForm):
         return proxy.get_value(resource, context, name, datatype)
 
 
+    def get_namespace(self, resource, context):
+        # Report the progress of the invitations being sent
+        job = mass_subscriptions.get(str(resource.abspath))
+        if job is not None:
+            if type(context.message) is not list:
+                context.message = [context.message] if context.message else []
+            job.add_messages(context)
+
+        proxy = super(MassSubscriptionForm, self)
+        return proxy.get_namespace(resource, context)
+
+
     def action_mass_subscribe(self, resource, context, form):
-        root = context.root
+        job = mass_subscriptions.get(str(resource.abspath))
+        if job is not None and job.is_running():
+            context.message = MSG_MASS_SUBSCRIPTION_RUNNING
+            return
 
-        already = []
-        unallowed = []
-        invited = []
+        emails = []
         invalid = []
-        subscribed_users = resource.get_subscribed_users()
+        seen = set()
         for email in form['emails']:
             email = email.strip()
-            if not email:
+            if not email or email in seen:
                 continue
+            seen.add(email)
             # Check if email is valid
             if not Email.is_valid(email):
                 invalid.append(email)
                 continue
-
-            # Checks
-            user = root.get_user_from_login(email)
-            if user:
-                if user.name in subscribed_users:
-                    already.append(user)
-                    continue
-                if not resource.is_subscription_allowed(user.name):
-                    unallowed.append(user)
-                    continue
-
-            # Subscribe
-            user = resource.subscribe_user(email=email, user=user)
-            key = resource.set_register_key(user.name)
-            # Send invitation
-            subject = resource.invitation_subject.gettext()
-            confirm_url = context.uri.resolve(';accept_invitation')
-            confirm_url.query = {'key': key, 'email': email}
-            text = resource.invitation_text.gettext(uri=confirm_url)
-            root.send_email(email, subject, text=text)
-            invited.append(user)
+            emails.append(email)
 
         # Ok
         context.message = []
-        add_subscribed_message(MSG_ALREADY, already, context)
         add_subscribed_message(MSG_INVALID, invalid, context,
                                users_is_resources=False)
-        add_subscribed_message(MSG_INVITED, invited, context)
-        add_subscribed_message(MSG_UNALLOWED, unallowed, context)
+        if emails:
+            # Subscribe and send the invitations in the background
+            MassSubscription(resource, context, emails).start()
 
 
 
@@ -597,6 +603,25 @@ class Observable(Resource):
         return user
 
 
+    def subscribe_users(self, usernames):
+        """Subscribe the given users waiting for their confirmation, like
+        subscribe_user followed by set_register_key for every user, but
+        updating the list of followers once.  Return the keys
+        {username: key}.
+        """
+        keys = {}
+        for username in usernames:
+            keys[username] = generate_password(30)
+        # Filter out the usernames
+        cc_list = self.get_property('cc_list')
+        cc_list = [ cc for cc in cc_list if cc.value not in keys ]
+        for username in usernames:
+            key = keys[username]
+            cc_list.append(MetadataProperty(username, status='S', key=key))
+        self.set_property('cc_list', cc_list)
+        return keys
+
+
     def unsubscribe_user(self, username):
         cc_list = self.get_property('cc_list')
         # Filter out username
@@ -681,3 +706,149 @@ class Observable(Resource):
     confirm_register = ConfirmSubscription
     confirm_unregister = ConfirmUnsubscription
     accept_invitation = AcceptInvitation
+
+
+
+###########################################################################
+# Mass subscription
+###########################################################################
+# The mass subscriptions {abspath: MassSubscription}
+mass_subscriptions = {}
+
+
+class MassSubscription(object):
+    """Subscribe a list of addresses to a resource and send them an
+    invitation, in the background and by batches, every batch committed on
+    its own (see MassSubscriptionForm).
+    """
+
+    batch_size = 100
+
+
+    def __init__(self, resource, context, emails):
+        self.abspath = str(resource.abspath)
+        self.server = context.server
+        user = context.user
+        self.userpath = str(user.abspath) if user else None
+        self.emails = emails
+        # The number of addresses processed
+        self.done = 0
+        self.failed = False
+        # The user names, by result
+        self.already = []
+        self.unallowed = []
+        self.invited = []
+
+        # The invitation, rendered once
+        subject = resource.invitation_subject.gettext()
+        self.subject = u'[%s] %s' % (context.uri.authority, subject)
+        self.text = resource.invitation_text.gettext(uri=u'{uri}')
+        self.confirm_url = str(context.uri.resolve(';accept_invitation'))
+
+
+    def start(self):
+        mass_subscriptions[self.abspath] = self
+        cron(self.run, timedelta(seconds=1))
+
+
+    def is_running(self):
+        return not self.failed and self.done < len(self.emails)
+
+
+    def run(self):
+        from server import get_fake_context
+
+        server = self.server
+        database = server.database
+        context = get_fake_context(database, server.root.context_cls)
+        context.server = server
+        context.init_context()
+        context.is_cron = True
+        if self.userpath:
+            context.user = database.get_resource(self.userpath, soft=True)
+
+        try:
+            self.run_batch(context)
+            database.save_changes()
+        except Exception:
+            log_error('Mass subscription error\n' + format_exc())
+            database.abort_changes()
+            self.failed = True
+
+        return self.is_running()
+
+
+    def run_batch(self, context):
+        database = context.database
+        root = context.root
+        resource = root.get_resource(self.abspath)
+
+        # Find the users of the batch with one query (as they are now, the
+        # previous batches may have created some)
+        batch = self.emails[self.done:self.done + self.batch_size]
+        query = [ PhraseQuery('username', x) for x in batch ]
+        query = AndQuery(PhraseQuery('parent_paths', '/users'),
+                         OrQuery(*query))
+        found = {}
+        for brain in database.search(query).get_documents():
+            found.setdefault(brain.username, brain.name)
+
+        # Checks and create the missing users
+        users = root.get_resource('/users')
+        cls = database.get_resource_class('user')
+        subscribed = set(resource.get_subscribed_users())
+        invited = []
+        for email in batch:
+            username = found.get(email)
+            if username is None:
+                user = users.make_resource(None, cls)
+                user.set_property(user.login_name_property, email)
+                # Mark it as new
+                key = generate_password(30)
+                user.set_property('user_state', 'pending', key=key)
+                username = user.name
+            elif username in subscribed:
+                self.already.append(username)
+                continue
+            elif not resource.is_subscription_allowed(username):
+                self.unallowed.append(username)
+                continue
+            invited.append((email, username))
+
+        # Subscribe
+        keys = resource.subscribe_users([ x[1] for x in invited ])
+
+        # Send the invitations
+        for email, username in invited:
+            query = encode_query({'key': keys[username], 'email': email})
+            uri = '%s?%s' % (self.confirm_url, query)
+            text = self.text.replace(u'{uri}', unicode(uri))
+            root.send_email(email, self.subject, text=text,
+                            subject_with_host=False)
+            self.invited.append(username)
+
+        self.done += len(batch)
+
+
+    def add_messages(self, context):
+        """Add to the context the messages reporting the progress, or the
+        results once done.
+        """
+        total = len(self.emails)
+        if self.failed:
+            message = MSG_MASS_SUBSCRIPTION_FAILED(done=self.done, total=total)
+            context.message.append(message)
+        elif self.is_running():
+            message = MSG_MASS_SUBSCRIPTION(done=self.done, total=total)
+            context.message.append(message)
+            return
+
+        # Done
+        del mass_subscriptions[self.abspath]
+        get_user = context.root.get_user
+        for message, usernames in [(MSG_ALREADY, self.already),
+                                   (MSG_INVITED, self.invited),
+                                   (MSG_UNALLOWED, self.unallowed)]:
+            users = [ get_user(x) for x in usernames ]
+            users = [ x for x in users if x is not None ]
+            add_subscribed_message(message, users, context)
@@ -28,10 +28,10 @@ from itools.web import STLView, INFO, ERROR
 from itools.database import PhraseQuery
 
 # Import from ikaaro
+from database import get_links_index
 from folder import Folder
 from folder_views import Folder_BrowseContent
 from messages import MSG_CHANGES_SAVED
-from utils import get_base_path_query
 
 
 ###########################################################################
@@ -111,23 +111,10 @@ class Config_BrokenLinks(STLView):
 
 
     def get_namespace(self, resource, context):
-        # Find out broken links
+        # Find out the broken links from within the given resource
         base = resource.abspath
-
-        # Search only within the given resource
-        query = get_base_path_query(base, min_depth=0)
-        results = context.search(query)
-
-        # Find out the broken links
-        root = context.root
-        broken = {}
-        for link in context.database.catalog.get_unique_values('links'):
-            if root.get_resource(link, soft=True) is not None:
-                continue
-            sub_results = results.search(PhraseQuery('links', link))
-            link = str(base.get_pathto(Path(link)))
-            for brain in sub_results.get_documents():
-                broken.setdefault(brain.abspath, []).append(link)
+        links_index = get_links_index(context.database)
+        broken = links_index.get_broken_links(base)
 
         # Build the namespace
         items = []
@@ -135,7 +122,7 @@ class Config_BrokenLinks(STLView):
         keys = broken.keys()
         keys.sort()
         for path in keys:
-            links = broken[path]
+            links = [ str(base.get_pathto(Path(x))) for x in broken[path] ]
             path = str(base.get_pathto(Path(path)))
             n = len(links)
             items.append({'path': path, 'links': links, 'n': n})
@@ -169,8 +156,8 @@ class Config_Orphans(Folder_BrowseContent):
         items = super(Config_Orphans, self).get_items(context.root, context)
 
         # Show only the orphan resources
-        items = [ x for x in items.get_documents()
-                  if len(context.database.search(links=x.abspath)) == 0 ]
+        orphans = get_links_index(context.database).orphans
+        items = [ x for x in items.get_documents() if x.abspath in orphans ]
 
         # Transform back the items found in a SearchResults object.
         # FIXME This is required by 'get_item_value', we should change that,
@@ -28,6 +28,7 @@ from autoedit import AutoEdit
 from buttons import Remove_BrowseButton
 from config import Configuration
 from config_common import NewResource_Local
+from database import register_commit_hook
 from enumerates import Groups_Datatype
 from fields import Select_Field
 from folder import Folder
@@ -191,6 +192,21 @@ class AccessRule(DBResource):
 ###########################################################################
 # Configuration module
 ###########################################################################
+
+# The queries compiled from the access rules, shared by all requests.  Keyed
+# by (database, user groups, permission, class_id), see
+# ConfigAccess.get_rules_query
+rules_queries = {}
+
+def clear_rules_queries(paths):
+    for path in paths:
+        if path.startswith(('/config/access', '/config/groups')):
+            rules_queries.clear()
+            return
+
+register_commit_hook(clear_rules_queries)
+
+
 class ConfigAccess_Browse(Folder_BrowseContent):
 
     query_schema = Folder_BrowseContent.query_schema.copy()
@@ -329,13 +345,22 @@ class ConfigAccess(Folder):
         return user_groups, '/config/groups/admins' in user_groups
 
 
-    def get_search_query(self, user, permission, class_id=None):
-        # Special case: admins can see everything
-        user_groups, is_admin = self._get_user_groups(user)
-        if is_admin:
-            return AllQuery()
+    def get_rules_query(self, user_groups, permission, class_id=None):
+        """Returns the query built from the access rules that apply to the
+        given user groups.  The query is compiled once and shared until an
+        access rule or a group is changed.  It is not shared while the
+        current transaction has changes, that may be aborted.
+        """
+        if permission != 'add':
+            class_id = None
+        database = self.database
+        shared = not getattr(database, 'has_changed', False)
+        key = (database, frozenset(user_groups), permission, class_id)
+        if shared:
+            rules_query = rules_queries.get(key)
+            if rules_query is not None:
+                return rules_query
 
-        # 1. Back-office access rules
         rules_query = OrQuery()
         for rule in self.get_resources():
             if rule.get_value('permission') != permission:
@@ -351,6 +376,20 @@ class ConfigAccess(Folder):
 
             rules_query.append(rule.get_search_query())
 
+        if shared:
+            rules_queries[key] = rules_query
+        return rules_query
+
+
+    def get_search_query(self, user, permission, class_id=None):
+        # Special case: admins can see everything
+        user_groups, is_admin = self._get_user_groups(user)
+        if is_admin:
+            return AllQuery()
+
+        # 1. Back-office access rules
+        rules_query = self.get_rules_query(user_groups, permission, class_id)
+
         # Case: anonymous
         if not user:
             return AndQuery(rules_query, PhraseQuery('share', 'everybody'))
@@ -367,15 +406,76 @@ class ConfigAccess(Folder):
         return query
 
 
+    def get_access_cache(self, context):
+        """Returns the permission decisions cached for the request.  Not
+        while the transaction has changes: the groups of the users or the
+        access rules may have changed, nothing is cached then.
+        """
+        if getattr(self.database, 'has_changed', False):
+            return {}
+        return context.access_cache
+
+
     def has_permission(self, user, permission, resource, class_id=None):
+        # Cache lookup
+        context = get_context()
+        abspath = str(resource.abspath)
+        userid = str(user.abspath) if user else None
+        key = (userid, permission, abspath, class_id)
+        cache = self.get_access_cache(context)
+        if key in cache:
+            return cache[key]
+
+        # The query
+        query = AndQuery(
+            self.get_search_query(user, permission, class_id),
+            PhraseQuery('abspath', abspath))
+
+        # Search
+        results = context.search(query, user=user)
+        cache[key] = allowed = len(results) > 0
+        return allowed
+
+
+    def get_allowed_paths(self, user, permission, resources, class_id=None):
+        """Returns the subset of the given resources (or absolute paths) the
+        user has the permission on, as a set of absolute paths.  The
+        decisions not yet cached are computed with a single search.
+        """
+        context = get_context()
+        userid = str(user.abspath) if user else None
+        cache = self.get_access_cache(context)
+
+        allowed = set()
+        missing = set()
+        for resource in resources:
+            if isinstance(resource, DBResource):
+                abspath = str(resource.abspath)
+            else:
+                abspath = str(resource)
+            key = (userid, permission, abspath, class_id)
+            if key not in cache:
+                missing.add(abspath)
+            elif cache[key]:
+                allowed.add(abspath)
+
+        if not missing:
+            return allowed
+
         # The query
+        paths_query = OrQuery(*[ PhraseQuery('abspath', x) for x in missing ])
         query = AndQuery(
             self.get_search_query(user, permission, class_id),
-            PhraseQuery('abspath', str(resource.abspath)))
+            paths_query)
 
         # Search
-        results = get_context().search(query, user=user)
-        return len(results) > 0
+        results = context.search(query, user=user)
+        found = set([ x.abspath for x in results.get_documents() ])
+        for abspath in missing:
+            key = (userid, permission, abspath, class_id)
+            cache[key] = abspath in found
+        allowed.update(found & missing)
+        return allowed
 
 
     def get_document_types(self):
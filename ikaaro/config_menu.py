@@ -30,12 +30,35 @@ from autoform import PathSelectorWidget
 from config import Configuration
 from config_common import NewResource_Local
 from buttons import Remove_BrowseButton
+from database import register_commit_hook
 from fields import Select_Field, URI_Field
 from order import OrderedFolder, OrderedFolder_BrowseContent
 from utils import split_reference
 
 
 
+# The menu trees shared by the requests, see ConfigMenu.get_menu_namespace.
+# Emptied when a menu, an access rule or a group, or the target of a menu
+# item is changed.
+menu_trees = {}
+menu_paths = set()
+
+def clear_menu_trees(paths):
+    for path in paths:
+        if path in menu_paths or path.startswith(('/config/access',
+                                                  '/config/groups')):
+            break
+        if any([ path.startswith(x + '/') for x in menu_paths ]):
+            break
+    else:
+        return
+    menu_trees.clear()
+    menu_paths.clear()
+
+register_commit_hook(clear_menu_trees)
+
+
+
 class Target_Field(Select_Field):
 
     default = '_top'
@@ -132,19 +155,22 @@ class MenuItem(OrderedFolder):
         return len(resource_views) > 0
 
 
-    def get_menu_namespace_level(self, context, url, use_first_child=False):
+    def get_menu_tree(self, context, use_first_child=False):
+        """Return the items of the menu the user is allowed to access, with
+        only what does not depend on the current page (see
+        get_menu_namespace_level).
+        """
         menu_abspath = self.abspath
-        here = context.resource
-        here_abspath = here.abspath
-        here_view_name = url[-1]
-        here_abspath_and_view = '%s/%s' % (here_abspath, here_view_name)
+        menu_paths.add(str(menu_abspath))
         items = []
 
         for resource in self.get_resources_in_order():
             uri = resource.get_value('path')
+            ref, path, view = split_reference(uri)
+            if not ref.scheme and path:
+                menu_paths.add(str(menu_abspath.resolve2(path)))
             if not self._is_allowed_to_access(context, uri):
                 continue
-            ref, path, view = split_reference(uri)
             title = resource.get_value('title')
             target = resource.get_value('target')
 
@@ -155,25 +181,20 @@ class MenuItem(OrderedFolder):
                     'path': str(ref),
                     'real_path': None,
                     'title': title,
-                    'description': None,
-                    'in_path': False,
-                    'active': False,
-                    'class': None,
                     'target': target,
-                    'items': []})
+                    'items': [],
+                    'abspath_and_view': None,
+                    'original_abspath': None})
                 continue
 
             # Case 2: Internal link
             # Sub level
-            subtabs = resource.get_menu_namespace_level(context, url,
-                                                        use_first_child)
+            subtabs = resource.get_menu_tree(context, use_first_child)
             resource = self.get_resource(path, soft=True)
             item_id = 'menu_%s' % resource.name
 
             # Use first child by default we use the resource itself
             resource_path = path
-            # Keep the real path to avoid highlight problems
-            resource_original_path = path
             # use first child
             if use_first_child and subtabs:
                 sub_path = subtabs[0]['real_path']
@@ -181,8 +202,6 @@ class MenuItem(OrderedFolder):
                 if sub_path is not None:
                     resource_path = sub_path
 
-            # Set active, in_path
-            active = in_path = False
             # add default view
             if view:
                 resource_method = view[2:]
@@ -191,17 +210,6 @@ class MenuItem(OrderedFolder):
                 resource_method = resource.get_default_view_name()
             resource_abspath_and_view = '%s/;%s' % (resource.abspath,
                                                     resource_method)
-            if here_abspath_and_view == resource_abspath_and_view:
-                active = True
-            else:
-                # Use the original path for the highlight
-                res_abspath = menu_abspath.resolve2(resource_original_path)
-                common_prefix = here_abspath.get_prefix(res_abspath)
-                # Avoid to always set the root entree 'in_path'
-                # If common prefix equals root abspath set in_path to False
-                # otherwise compare common_prefix and res_abspath
-                if common_prefix != Path('/'):
-                    in_path = (common_prefix == res_abspath)
 
             # Build the new reference with the right path
             ref2 = deepcopy(ref)
@@ -215,11 +223,58 @@ class MenuItem(OrderedFolder):
                 'path': str(ref2),
                 'real_path': resource.abspath,
                 'title': title,
+                'target': target,
+                'items': subtabs,
+                'abspath_and_view': resource_abspath_and_view,
+                # Keep the real path to avoid highlight problems
+                'original_abspath': menu_abspath.resolve2(path)})
+
+        return items
+
+
+    def get_menu_namespace_level(self, context, url, use_first_child=False,
+                                 tree=None):
+        if tree is None:
+            tree = self.get_menu_tree(context, use_first_child)
+
+        here_abspath = context.resource.abspath
+        here_view_name = url[-1]
+        here_abspath_and_view = '%s/%s' % (here_abspath, here_view_name)
+        items = []
+
+        for item in tree:
+            # Set active, in_path
+            active = in_path = False
+            resource_abspath_and_view = item['abspath_and_view']
+            if resource_abspath_and_view is None:
+                # External link
+                pass
+            elif here_abspath_and_view == resource_abspath_and_view:
+                active = True
+            else:
+                # Use the original path for the highlight
+                res_abspath = item['original_abspath']
+                common_prefix = here_abspath.get_prefix(res_abspath)
+                # Avoid to always set the root entree 'in_path'
+                # If common prefix equals root abspath set in_path to False
+                # otherwise compare common_prefix and res_abspath
+                if common_prefix != Path('/'):
+                    in_path = (common_prefix == res_abspath)
+
+            # Sub level
+            subtabs = self.get_menu_namespace_level(context, url,
+                                                    use_first_child,
+                                                    item['items'])
+            items.append({
+                'id': item['id'],
+                'path': item['path'],
+                'real_path': item['real_path'],
+                'title': item['title'],
                 'description': None, # FIXME
                 'in_path': active or in_path,
                 'active': active,
                 'class': None,
-                'target': target,
+                'target': item['target'],
                 'items': subtabs})
 
         # Set class
@@ -316,7 +371,26 @@ class ConfigMenu(MenuItem):
             if menu is None:
                 return []
 
-        return menu.get_menu_namespace_level(context, url, show_first_child)
+        # The tree depends on the access rights (the groups, the ownership
+        # and sharing of the targets) and the language of the titles
+        user = context.user
+        if user is None:
+            userid, groups = None, frozenset()
+        else:
+            userid = str(user.abspath)
+            groups = frozenset(user.get_value('groups'))
+        languages = context.root.get_value('website_languages')
+        language = context.accept_language.select_language(languages)
+        key = (str(menu.abspath), show_first_child, userid, groups, language)
+        tree = menu_trees.get(key)
+        if tree is None:
+            if len(menu_trees) > 1000:
+                menu_trees.clear()
+            tree = menu.get_menu_tree(context, show_first_child)
+            menu_trees[key] = tree
+
+        return menu.get_menu_namespace_level(context, url, show_first_child,
+                                             tree)
 
 
 
@@ -14,13 +14,16 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Import from the Standard Library
+from time import time
+
 # Import from itools
 from itools.core import freeze, proto_lazy_property
 from itools.fs import lfs
 from itools.handlers import ro_database
 from itools.i18n import has_language
 from itools.uri import Path, normalize_path
-from itools.web import Context
+from itools.web import Context, set_context
 
 # Import from ikaaro
 from skins import skin_registry
@@ -41,6 +44,101 @@ class CMSContext(Context):
         self.is_cron = False
 
 
+    @proto_lazy_property
+    def response_headers(self):
+        """The response headers set, {name: value}.
+        """
+        return {}
+
+
+    def set_header(self, name, value):
+        super(CMSContext, self).set_header(name, value)
+        # Keep them for the page cache (they cannot be read from the soup
+        # message)
+        self.response_headers[name.lower()] = value
+
+
+    #######################################################################
+    # Page cache
+    def handle_request(self, soup_message, path):
+        proxy = super(CMSContext, self)
+        cache = getattr(self.server, 'page_cache', None)
+        if (cache is None or path is None
+                or not self.is_page_cacheable(soup_message)):
+            return proxy.handle_request(soup_message, path)
+
+        # Find out the key (the language is negotiated by before_traverse)
+        start_time = time()
+        context = self()
+        context.soup_message = soup_message
+        context.path = path
+        set_context(context)
+        try:
+            context.init_context()
+            key = context.get_page_cache_key()
+        except Exception:
+            # Bad request: itools answers with the right error
+            key = None
+        finally:
+            set_context(None)
+        if key is None:
+            return proxy.handle_request(soup_message, path)
+
+        # Hit
+        page = cache.get(key)
+        if page is not None:
+            context.status = 200
+            context.content_type, context.entity, headers = page
+            for name, value in headers.iteritems():
+                context.set_header(name, value)
+            context.set_response_from_context()
+            self.server.request_time = time() - start_time
+            return context
+
+        # Miss: itools initializes a new context, so the context is
+        # initialized twice (the cost of a miss, with authentication and
+        # before_traverse, both cheap for anonymous requests)
+        context = proxy.handle_request(soup_message, path)
+        if (context.status == 200 and context.user is None
+                and not context.cookies and type(context.entity) is str
+                and context.content_type
+                and context.content_type.startswith('text/html')):
+            cache.set(key, context.content_type, context.entity,
+                      context.response_headers)
+        return context
+
+
+    def is_page_cacheable(self, soup_message):
+        """Only anonymous GET requests are cached.  Requests changing the
+        language are not, since the language cookie is set.
+        """
+        if soup_message.get_method() != 'GET':
+            return False
+        if soup_message.get_header('Authorization'):
+            return False
+        cookies = soup_message.get_header('Cookie')
+        if cookies and 'iauth=' in cookies:
+            return False
+        query = soup_message.get_query()
+        if query and 'language=' in query:
+            return False
+        return True
+
+
+    def get_page_cache_key(self):
+        """The page depends on the scheme and host (which give the absolute
+        links and the skin), the path with the view, the query and the
+        negotiated language.
+        """
+        if self.user is not None:
+            return None
+        languages = self.root.get_value('website_languages')
+        language = self.accept_language.select_language(languages)
+        uri = self.uri
+        return (uri.scheme, uri.authority, str(uri.path), str(uri.query),
+                language)
+
+
     def come_back(self, message, goto=None, keep=freeze([]), **kw):
         goto = super(CMSContext, self).come_back(message, goto, keep, **kw)
         # Keep fancybox
@@ -81,6 +179,15 @@ class CMSContext(Context):
 
 
     def get_template_from_skin_key(self, skin_key, web_path, warning):
+        # The index of the skins, built when the server starts
+        templates = getattr(self.server, 'templates', None)
+        if templates is not None:
+            template = templates.get_template(skin_key, web_path,
+                                              self.accept_language)
+            if template and warning:
+                print warning
+            return template
+
         local_path = skin_key + web_path
         # 3. Get the handler
         handler = ro_database.get_handler(local_path, soft=True)
@@ -116,6 +223,21 @@ class CMSContext(Context):
         return ro_database.get_handler(local_path)
 
 
+    #######################################################################
+    # Access control
+    @proto_lazy_property
+    def access_cache(self):
+        """Permission decisions taken during this request, keyed by
+        (userid, permission, abspath, class_id).  See
+        ConfigAccess.has_permission
+        """
+        return {}
+
+
+    def clear_access_cache(self):
+        self.access_cache.clear()
+
+
     #######################################################################
     # Search
     def _user_search(self, user):
@@ -15,19 +15,200 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from standard library
+from bisect import bisect_left
 from copy import deepcopy
+from datetime import datetime
+from os import listdir, remove, rename, rmdir
+from os.path import dirname, exists, join
+from re import search
+
+# Import from pygit2
+from pygit2 import GIT_SORT_TIME
 
 # Import from itools
+from itools.core import lazy
 from itools.database import RODatabase, RWDatabase, make_git_database
-from itools.database import OrQuery, PhraseQuery
+from itools.database import AllQuery, OrQuery, PhraseQuery
+from itools.database.git import message_short
+from itools.fs import lfs
 from itools.uri import Path
 from itools.web import get_context
 
 
+###########################################################################
+# Commit hooks
+###########################################################################
+commit_hooks = []
+def register_commit_hook(hook):
+    """Register a callable to be called at commit time, with the set of the
+    absolute paths (strings) of the resources added, changed, moved or
+    removed in the transaction.  Used to invalidate the caches.
+    """
+    commit_hooks.append(hook)
+
+
+
+###########################################################################
+# Reverse index of the "onchange_reindex" field
+###########################################################################
+class ReverseIndex(object):
+    """In-memory reverse index of a multiple, stored, catalog field holding
+    absolute paths (e.g. 'onchange_reindex'): maps a path to the set of the
+    resources that reference it.
+
+    The entries are loaded from the catalog on demand, and kept up-to-date
+    at commit time by 'update'.  They are all forgotten when there are more
+    than 'size_max' of them.
+    """
+
+    def __init__(self, field_name, size_max=100000):
+        self.field_name = field_name
+        self.size_max = size_max
+        self.sources = {} # target => set of sources
+        self.targets = {} # source => set of targets (of the loaded entries)
+
+
+    def _add(self, source, target):
+        self.sources[target].add(source)
+        self.targets.setdefault(source, set()).add(target)
+
+
+    def _remove(self, source):
+        for target in self.targets.pop(source, ()):
+            self.sources[target].discard(source)
+
+
+    def get_sources(self, database, paths):
+        """Returns the set of the resources that reference any of the given
+        paths.
+        """
+        field_name = self.field_name
+        sources = self.sources
+
+        # Load the missing entries, with one query for 200 paths
+        # (XXX Xapian is slow when there's too much items in OrQuery)
+        missing = [ x for x in paths if x not in sources ]
+        if missing and len(sources) + len(missing) > self.size_max:
+            sources.clear()
+            self.targets.clear()
+            missing = list(paths)
+        for n in range(0, len(missing), 200):
+            chunk = missing[n:n+200]
+            for target in chunk:
+                sources[target] = set()
+            query = OrQuery(*[ PhraseQuery(field_name, x) for x in chunk ])
+            for brain in database.search(query).get_documents():
+                targets = getattr(brain, field_name, None)
+                if type(targets) is str:
+                    targets = [targets]
+                if targets:
+                    targets = [ x for x in targets if x in sources ]
+                else:
+                    # Not stored (the catalog predates it), assume the
+                    # resource references all of them (the field stays
+                    # unstored until the catalog is rebuilt)
+                    targets = chunk
+                for target in targets:
+                    self._add(brain.abspath, target)
+
+        # Ok
+        result = set()
+        for path in paths:
+            result.update(sources[path])
+        return result
+
+
+    def update(self, unindexed, indexed):
+        """Updates the loaded entries with the documents being unindexed
+        (a list of paths) and indexed (a list of catalog values).
+        """
+        field_name = self.field_name
+        for source in unindexed:
+            self._remove(source)
+
+        for values in indexed:
+            source = values['abspath']
+            self._remove(source)
+            targets = values.get(field_name) or ()
+            if type(targets) is str:
+                targets = [targets]
+            for target in targets:
+                if target in self.sources:
+                    self._add(source, target)
+
+
+
+def get_onchange_reindex(database, paths):
+    """Returns the set of the resources to reindex because they depend,
+    directly or not, on the resources with the given paths.  Only the
+    paths not yet expanded are looked up at every round.
+    """
+    index = getattr(database, 'onchange_index', None)
+    if index is None:
+        index = ReverseIndex('onchange_reindex')
+
+    to_reindex = set()
+    seen = set(paths)
+    frontier = seen
+    while frontier:
+        sources = index.get_sources(database, frontier)
+        to_reindex.update(sources)
+        frontier = sources - seen
+        seen.update(frontier)
+
+    return to_reindex
+
+
+
 class Database(RWDatabase):
     """Adds a Git archive to the itools database.
     """
 
+    links_index = None
+
+    @lazy
+    def onchange_index(self):
+        return ReverseIndex('onchange_reindex')
+
+
+    @lazy
+    def copied(self):
+        """The keys of the files copied by 'Folder.copy_resource' in this
+        transaction (they are added without a handler in the cache).
+        """
+        return set()
+
+
+    def _abort_changes(self):
+        # Remove the copied files, the handlers not in the cache cannot be
+        # discarded
+        cache = self.cache
+        fs = self.fs
+        folders = set()
+        for key in self.copied:
+            if key not in cache:
+                self.added.discard(key)
+            path = fs.get_absolute_path(key)
+            if exists(path):
+                remove(path)
+            folders.add(dirname(path))
+        # And the folders left empty
+        root = fs.get_absolute_path('.')
+        for path in sorted(folders, key=len, reverse=True):
+            while path.startswith(root + '/'):
+                if not exists(path) or listdir(path):
+                    break
+                rmdir(path)
+                path = dirname(path)
+
+        super(Database, self)._abort_changes()
+
+
+    def _cleanup(self):
+        super(Database, self)._cleanup()
+        self.copied.clear()
+
+
     def _before_commit(self):
         context = get_context()
         root = context.root
@@ -50,22 +231,7 @@ class Database(RWDatabase):
 
         # 2. Find out resources to re-index because they depend on another
         # resource that changed
-        to_reindex = set()
-        aux = set()
-        aux2 = set(self.resources_old2new.keys())
-        while len(aux) != len(aux2):
-            aux = set(aux2)
-            # XXX we regroup items by 200 because Xapian is slow
-            # when there's too much items in OrQuery
-            l_aux = list(aux)
-            for sub_aux in [l_aux[n:n+200] for n in range(0, len(l_aux), 200)]:
-                query = [ PhraseQuery('onchange_reindex', x) for x in sub_aux ]
-                query = OrQuery(*query)
-                search = self.search(query)
-                for brain in search.get_documents():
-                    path = brain.abspath
-                    aux2.add(path)
-                    to_reindex.add(path)
+        to_reindex = get_onchange_reindex(self, self.resources_old2new.keys())
 
         # 3. Documents to unindex (the update_links methods calls
         # 'change_resource' which may modify the resources_old2new dictionary)
@@ -85,14 +251,30 @@ class Database(RWDatabase):
         # 5. Index
         docs_to_index = self.resources_new2old.keys()
         docs_to_index = list(set(docs_to_index) | to_reindex)
+        changed_paths = set(docs_to_index) | set(docs_to_unindex)
         aux = []
-        for path in docs_to_index:
+        for i, path in enumerate(docs_to_index):
             resource = root.get_resource(path, soft=True)
             if resource:
                 values = resource.get_catalog_values()
-                aux.append((resource, values))
+                aux.append((path, values))
+            # Big copies: do not keep every handler in memory
+            if i % 1000 == 999:
+                self.make_room()
         docs_to_index = aux
         self.resources_new2old.clear()
+        # The indexes are updated once the transaction is committed
+        self._onchange_changes = (
+            docs_to_unindex, [ values for kk, values in docs_to_index ])
+        links_changes = [ (x, None) for x in docs_to_unindex ]
+        links_changes.extend([ (values['abspath'], values['links'])
+                               for kk, values in docs_to_index ])
+        self._links_changes = links_changes
+
+        # Notify the caches depending on the changed resources
+        for hook in commit_hooks:
+            hook(changed_paths)
+        self._commit_pending = True
 
         # 6. Find out commit author & message
         if user:
@@ -116,6 +298,37 @@ class Database(RWDatabase):
         return git_author, git_date, git_msg, docs_to_index, docs_to_unindex
 
 
+    _commit_pending = False
+    _onchange_changes = None
+    _links_changes = None
+    def save_changes(self):
+        proxy = super(Database, self)
+        try:
+            proxy.save_changes()
+            # Keep track of the last commit indexed by the catalog
+            watermark = None
+            if self._commit_pending:
+                watermark = get_head_sha(self)
+                set_catalog_watermark(self.path, watermark)
+            # Update the reverse index of 'onchange_reindex'
+            if self._onchange_changes:
+                self.onchange_index.update(*self._onchange_changes)
+            # Update the links index (after the catalog, the journal records
+            # the watermark so a crash in between is detected on load)
+            if self._links_changes:
+                update_links_index(self, self._links_changes, watermark)
+        finally:
+            self._commit_pending = False
+            self._onchange_changes = None
+            self._links_changes = None
+            # The catalog may have changed (access rules, user groups, share
+            # values...), forget the permissions computed so far
+            context = get_context()
+            clear_access_cache = getattr(context, 'clear_access_cache', None)
+            if clear_access_cache is not None:
+                clear_access_cache()
+
+
     def get_dynamic_classes(self):
         search = self.search(base_classes='-model')
         for brain in search.get_documents():
@@ -124,6 +337,358 @@ class Database(RWDatabase):
 
 
 
+###########################################################################
+# Links index
+###########################################################################
+class LinksIndex(object):
+    """Persistent reverse index of the links between resources, answers
+    "who links to this resource?" and "which resources are not linked from
+    anywhere?".
+
+    It also keeps the set of the broken links: the targets that are not
+    indexed resources.
+
+    It is stored in the catalog folder as a journal, every line is either
+    "+ source target1 target2 ..." (the resource 'source' links to the
+    given targets), "- source" (the resource was unindexed) or "= sha"
+    (the index is up-to-date with the catalog at the given commit),
+    separated by tabulations.  It is rebuilt from the catalog when missing
+    or out-of-sync with it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.sha = None      # catalog watermark the index is up-to-date with
+        self.sources = {}    # target => set of sources
+        self.targets = {}    # source => set of targets (all indexed docs)
+        self.orphans = set() # indexed docs without incoming links
+        self.broken = set()  # linked targets that are not indexed docs
+
+
+    def get_sources(self, target):
+        return self.sources.get(str(target), set())
+
+
+    _paths = None # sorted paths of the indexed docs, computed when needed
+    def get_paths(self, base):
+        """Returns the paths of the indexed resources within the given base
+        path (included).
+        """
+        paths = self._paths
+        if paths is None:
+            paths = self._paths = sorted(self.targets)
+
+        base = str(base).rstrip('/')
+        if base in self.targets:
+            yield base
+        prefix = '%s/' % base
+        for i in xrange(bisect_left(paths, prefix), len(paths)):
+            path = paths[i]
+            if not path.startswith(prefix):
+                break
+            yield path
+
+
+    def get_broken_links(self, base='/'):
+        """Returns a dict {source: [target, ...]} with the broken links from
+        the resources within the given base path.
+        """
+        base = str(base).rstrip('/')
+        prefix = '%s/' % base
+        broken = {}
+        for target in self.broken:
+            for source in self.sources[target]:
+                if source == base or source.startswith(prefix):
+                    broken.setdefault(source, []).append(target)
+
+        for links in broken.itervalues():
+            links.sort()
+        return broken
+
+
+    def _unset_links(self, source):
+        targets = self.targets.get(source)
+        if targets is None:
+            return
+
+        for target in targets:
+            sources = self.sources[target]
+            sources.discard(source)
+            if not sources:
+                del self.sources[target]
+                if target in self.targets:
+                    self.orphans.add(target)
+                else:
+                    self.broken.discard(target)
+        targets.clear()
+
+
+    def _set_links(self, source, targets):
+        self._unset_links(source)
+        # Unindex
+        if targets is None:
+            if self.targets.pop(source, None) is not None:
+                self._paths = None
+            self.orphans.discard(source)
+            if source in self.sources:
+                self.broken.add(source)
+            return
+
+        # Index
+        if source not in self.targets:
+            self._paths = None
+        self.targets.setdefault(source, set()).update(targets)
+        self.broken.discard(source)
+        for target in targets:
+            self.sources.setdefault(target, set()).add(source)
+            self.orphans.discard(target)
+            if target not in self.targets:
+                self.broken.add(target)
+        if source not in self.sources:
+            self.orphans.add(source)
+
+
+    def update(self, changes):
+        """The changes is a list of tuples (source, targets), where targets
+        is None when the source has been unindexed.
+        """
+        for source, targets in changes:
+            self._set_links(source, targets)
+
+
+    def load(self, sha=None, compact=False):
+        """Loads the index from the journal, returns False if it is missing
+        or not up-to-date with the catalog at the given commit.  The journal
+        is compacted if too long and 'compact' is true.
+        """
+        if not lfs.exists(self.path):
+            return False
+
+        n = 0
+        with open(self.path) as file:
+            for line in file:
+                line = line.rstrip('\n').split('\t')
+                if line[0] == '+':
+                    self._set_links(line[1], line[2:])
+                elif line[0] == '-':
+                    self._set_links(line[1], None)
+                else:
+                    self.sha = line[1]
+                n += 1
+
+        if sha is not None and self.sha != sha:
+            return False
+
+        # Compact the journal
+        if compact and n > 2 * len(self.targets) + 1000:
+            self.save()
+        return True
+
+
+    def build(self, database):
+        """Builds the index from the catalog.
+        """
+        for brain in database.search(AllQuery()).get_documents():
+            self.targets[brain.abspath] = set()
+        for target in database.catalog.get_unique_values('links'):
+            sources = set()
+            results = database.search(PhraseQuery('links', target))
+            for brain in results.get_documents():
+                source = brain.abspath
+                sources.add(source)
+                self.targets.setdefault(source, set()).add(target)
+            if sources:
+                self.sources[target] = sources
+
+        self.orphans = set([ x for x in self.targets if x not in self.sources ])
+        self.broken = set([ x for x in self.sources if x not in self.targets ])
+
+
+    def save(self):
+        tmp_path = '%s.tmp' % self.path
+        with open(tmp_path, 'w') as file:
+            for source, targets in self.targets.iteritems():
+                file.write(format_links_change(source, targets))
+            if self.sha is not None:
+                file.write('=\t%s\n' % self.sha)
+        rename(tmp_path, self.path)
+
+
+
+def format_links_change(source, targets):
+    if targets is None:
+        return '-\t%s\n' % source
+    return '\t'.join(['+', source] + list(targets)) + '\n'
+
+
+def get_links_index_path(database):
+    return join(database.path, 'catalog', 'links.index')
+
+
+def load_links_index(database, save=False):
+    """Loads the links index of the given database, building it from the
+    catalog if missing or out-of-sync with it.  The index is written (built
+    or compacted) only if 'save' is true: by the server in read-write mode
+    at start, and once the catalog is updated.
+    """
+    path = get_links_index_path(database)
+    watermark = get_catalog_watermark(database.path)
+    index = LinksIndex(path)
+    if not index.load(watermark, compact=save):
+        index = LinksIndex(path)
+        index.build(database)
+        index.sha = watermark
+        if save:
+            index.save()
+    database.links_index = index
+    return index
+
+
+def get_links_index(database):
+    """Returns the links index of the given database, loaded by the server
+    at start.
+    """
+    index = getattr(database, 'links_index', None)
+    if index is None:
+        index = load_links_index(database)
+    return index
+
+
+def update_links_index(database, changes, sha):
+    """Called once a transaction has been committed, the changes is a list
+    of tuples (source, targets), see 'LinksIndex.update', and the sha is the
+    new watermark of the catalog.
+    """
+    path = get_links_index_path(database)
+    # Not built yet (will be from the catalog, which is now up-to-date)
+    if not lfs.exists(path):
+        return
+
+    with open(path, 'a') as file:
+        for source, targets in changes:
+            file.write(format_links_change(source, targets))
+        if sha is not None:
+            file.write('=\t%s\n' % sha)
+
+    index = getattr(database, 'links_index', None)
+    if index is not None:
+        index.update(changes)
+        index.sha = sha
+
+
+
+###########################################################################
+# Catalog watermark: the last commit the catalog is up-to-date with
+###########################################################################
+def get_head_sha(database):
+    return database.worktree.git_log(None, 1)[0]['sha']
+
+
+def get_catalog_watermark(path):
+    try:
+        with open(join(path, 'catalog.watermark')) as file:
+            return file.read().strip() or None
+    except IOError:
+        return None
+
+
+def set_catalog_watermark(path, sha):
+    with open(join(path, 'catalog.watermark'), 'w') as file:
+        file.write(sha)
+
+
+
+###########################################################################
+# Commit log
+###########################################################################
+# The commits matching a query, newest first, at the given HEAD
+# {(paths, author, grep): (head sha, [sha, ...])}
+revisions_cache = {}
+revisions_cache_size = 100
+
+
+def match_commit(worktree, commit, paths=None, author=None, grep=None):
+    """Same filters as 'Worktree.git_log'.
+    """
+    # --author=<pattern>
+    if author:
+        commit_author = commit.author
+        if (not search(author, commit_author.name)
+                and not search(author, commit_author.email)):
+            return False
+
+    # --grep=<pattern>
+    if grep and not search(grep, commit.message):
+        return False
+
+    # -- path ...
+    if paths:
+        parents = commit.parents
+        parent = parents[0] if parents else None
+        for path in paths:
+            a = worktree.lookup_from_commit_by_path(commit, path)
+            if parent is None:
+                if a:
+                    return True
+            else:
+                b = worktree.lookup_from_commit_by_path(parent, path)
+                if a is not b:
+                    return True
+        return False
+
+    return True
+
+
+def get_revisions_shas(database, paths=None, author=None, grep=None):
+    """Return the SHAs of the commits matching the given filters (see
+    'Worktree.git_log'), newest first.  The result is kept until the next
+    commit, then only the new commits are walked.
+    """
+    worktree = database.worktree
+    head = get_head_sha(database)
+    key = (tuple(paths) if paths else None, author, grep)
+    old_head, old_shas = revisions_cache.get(key, (None, []))
+    if old_head == head:
+        return old_shas
+
+    shas = []
+    for commit in worktree.repo.walk(head, GIT_SORT_TIME):
+        sha = commit.hex
+        if sha == old_head:
+            shas.extend(old_shas)
+            break
+        if match_commit(worktree, commit, paths, author, grep):
+            shas.append(sha)
+
+    if len(revisions_cache) >= revisions_cache_size:
+        revisions_cache.clear()
+    revisions_cache[key] = (head, shas)
+    return shas
+
+
+def get_revisions_page(database, paths=None, start=0, size=None, author=None,
+                       grep=None):
+    """Return the number of commits matching the given filters, and the
+    commits from 'start' to 'start + size' in the same form as
+    'Worktree.git_log'.
+    """
+    shas = get_revisions_shas(database, paths, author, grep)
+    end = None if size is None else start + size
+
+    worktree = database.worktree
+    commits = []
+    for sha in shas[start:end]:
+        commit = worktree.lookup(sha)
+        commits.append(
+            {'sha': sha,
+             'author_name': commit.author.name,
+             'author_date': datetime.fromtimestamp(commit.commit_time),
+             'message_short': message_short(commit)})
+
+    return len(shas), commits
+
+
+
 def make_database(path):
     size_min, size_max = 19500, 20500
     make_git_database(path, size_min, size_max)
@@ -20,6 +20,11 @@
 
 # Import from the Standard Library
 from cStringIO import StringIO
+from fnmatch import fnmatch
+from os import makedirs, walk
+from os.path import dirname, exists, isfile, relpath
+from shutil import copy2
+from uuid import uuid4
 from zipfile import ZipFile
 
 # Import from itools
@@ -47,6 +52,31 @@ from utils import process_name, tidy_html
 
 
 
+def set_metadata_uuid(data, uuid):
+    """Return the given metadata file (a byte string) with the given UUID.
+    The properties are sorted by name (see Metadata.to_str).
+    """
+    lines = data.splitlines(True)
+    if lines and lines[-1][-1:] != '\n':
+        lines[-1] += '\n'
+    uuid = 'uuid:%s\n' % uuid
+    for i, line in enumerate(lines):
+        if i == 0 or line[:1] in (' ', '\t'):
+            # The format, or the continuation of a value
+            continue
+        name = line.split(':', 1)[0].split(';', 1)[0]
+        if name == 'uuid':
+            lines[i] = uuid
+            break
+        elif name > 'uuid':
+            lines.insert(i, uuid)
+            break
+    else:
+        lines.append(uuid)
+    return ''.join(lines)
+
+
+
 class Folder(DBResource):
 
     class_id = 'folder'
@@ -232,13 +262,84 @@ class Folder(DBResource):
         # instance copy&cut&paste of a tracker in a just started server.
         # TODO this is a work-around, there should be another way to define
         # explicitly the handler class.
+        # Only the handlers of the resource itself, the subtree is copied or
+        # moved as files.
         source = self.get_resource(source_path)
-        for resource in source.traverse_resources():
-            resource.load_handlers()
+        source.load_handlers()
 
         return source_path, target_path
 
 
+    def _has_pending_changes(self, keys):
+        """Whether the handlers at the given keys (files or folders) have
+        changes not yet saved.
+        """
+        database = self.database
+        prefixes = tuple([ '%s/' % x for x in keys ])
+        for pending in database.added, database.changed, database.removed:
+            for key in pending:
+                if key in keys or key.startswith(prefixes):
+                    return True
+        return False
+
+
+    def _copy_files(self, source, target, exclude_patterns):
+        """Copy the file or folder at the 'source' key to 'target', in the
+        filesystem, one file at a time.  The metadata files get a new UUID.
+        The copies are added to the transaction without loading them.
+        """
+        database = self.database
+        fs = database.fs
+        source_abs = fs.get_absolute_path(source)
+        target_abs = fs.get_absolute_path(target)
+
+        # Find out the files
+        if isfile(source_abs):
+            files = [('.', '')]
+        else:
+            files = []
+            for dirpath, dirnames, filenames in walk(source_abs):
+                path = relpath(dirpath, source_abs)
+                prefix = '' if path == '.' else '%s/' % path
+                for name in list(dirnames):
+                    key = '%s/%s%s' % (source, prefix, name)
+                    if [ x for x in exclude_patterns if fnmatch(key, x) ]:
+                        dirnames.remove(name)
+                files.extend([ (prefix, x) for x in filenames ])
+
+        # Copy
+        for prefix, name in files:
+            if name:
+                path = '%s%s' % (prefix, name)
+                src_key = '%s/%s' % (source, path)
+                dst_key = '%s/%s' % (target, path)
+                src_abs = '%s/%s' % (source_abs, path)
+                dst_abs = '%s/%s' % (target_abs, path)
+            else:
+                src_key, dst_key = source, target
+                src_abs, dst_abs = source_abs, target_abs
+            if [ x for x in exclude_patterns if fnmatch(src_key, x) ]:
+                continue
+            if database.has_handler(dst_key):
+                raise RuntimeError, 'the target "%s" is busy' % dst_key
+
+            parent = dirname(dst_abs)
+            if not exists(parent):
+                makedirs(parent)
+            if dst_key[-9:] == '.metadata':
+                with open(src_abs) as file:
+                    data = file.read()
+                with open(dst_abs, 'w') as file:
+                    file.write(set_metadata_uuid(data, uuid4().hex))
+            else:
+                copy2(src_abs, dst_abs)
+            database.added.add(dst_key)
+            database.removed.discard(dst_key)
+            database.copied.add(dst_key)
+
+        database.has_changed = True
+
+
     def copy_resource(self, source_path, target_path, exclude_patterns=None):
         # Find out the source and target absolute URIs
         source_path, target_path = self._resolve_source_target(source_path,
@@ -257,30 +358,49 @@ class Folder(DBResource):
                                      target_parent.class_title.gettext())
             raise ConsistencyError(message)
 
-        # Copy the metadata
-        folder = self.handler
-        folder.copy_handler('%s.metadata' % source_path,
-                            '%s.metadata' % target_path)
-
-        # Copy the content
+        # The handlers to copy
         database = self.database
         fs = database.fs
+        folder = self.handler
         new_name = target_path.get_name()
+        keys = [('%s.metadata' % source_path, '%s.metadata' % target_path)]
         for old_name, new_name in source.rename_handlers(new_name):
             if old_name is None:
                 continue
             src_key = fs.resolve(source_path, old_name)
             dst_key = fs.resolve(target_path, new_name)
             if folder.has_handler(src_key):
-                folder.copy_handler(src_key, dst_key, exclude_patterns)
+                keys.append((src_key, dst_key))
+        base = folder.key
+        normalize_key = database.normalize_key
+        keys = [ (normalize_key(fs.resolve2(base, str(x))),
+                  normalize_key(fs.resolve2(base, str(y))))
+                 for x, y in keys ]
+
+        # Copy the files, unless there are changes not yet saved (then the
+        # handlers are copied, loading them)
+        if exclude_patterns is None:
+            exclude_patterns = []
+        if self._has_pending_changes([ x for pair in keys for x in pair ]):
+            for resource in source.traverse_resources():
+                resource.load_handlers()
+            for src_key, dst_key in keys:
+                database.copy_handler(src_key, dst_key, exclude_patterns)
+            copied = False
+        else:
+            for src_key, dst_key in keys:
+                self._copy_files(src_key, dst_key, exclude_patterns)
+            copied = True
 
-        # Events, add
+        # Events, add (do not keep the whole subtree in memory)
         resource = self.get_resource(target_path)
-        database.add_resource(resource)
-        # Set UUID
-        resource.set_uuid()
-        for x in resource.traverse_resources():
-            x.set_uuid()
+        new2old = database.resources_new2old
+        for i, x in enumerate(resource.traverse_resources()):
+            new2old[str(x.abspath)] = None
+            if not copied:
+                x.set_uuid()
+            elif i % 1000 == 999:
+                database.make_room()
         # Ok
         return resource
 
@@ -327,6 +447,8 @@ class Folder(DBResource):
             dst_key = fs.resolve(target_path, new_name)
             if folder.has_handler(src_key):
                 folder.move_handler(src_key, dst_key)
+        # The subtree has been loaded by 'database.move_resource'
+        database.make_room()
 
 
     def search_resources(self, cls=None, format=None):
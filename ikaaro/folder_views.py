@@ -482,11 +482,17 @@ class Folder_BrowseContent(BrowseForm):
             elif start:
                 items = items[start:]
             database = resource.database
-            return [ database.get_resource(x.abspath) for x in items ]
-
+            items = [ database.get_resource(x.abspath) for x in items ]
         # Case 2: Faster Xapian sort algorithm
-        items = results.get_resources(sort_by, reverse, start, size)
-        return list(items)
+        else:
+            items = results.get_resources(sort_by, reverse, start, size)
+            items = list(items)
+
+        # Compute in bulk the permissions checked for every row
+        root = context.root
+        for permission in ('view', 'edit'):
+            root.get_allowed_paths(context.user, permission, items)
+        return items
 
 
     def get_item_value(self, resource, context, item, column):
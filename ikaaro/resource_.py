@@ -29,7 +29,7 @@ from uuid import uuid4
 from itools.core import is_prototype, lazy
 from itools.database import MetadataProperty
 from itools.database import Resource, Metadata, register_field
-from itools.database import AndQuery, NotQuery, PhraseQuery
+from itools.database import PhraseQuery
 from itools.datatypes import Boolean, DateTime, Date
 from itools.datatypes import Integer, String, Unicode
 from itools.gettext import MSG
@@ -42,10 +42,12 @@ from itools.web import BaseView, get_context
 from autoadd import AutoAdd
 from autoedit import AutoEdit
 from autoform import CheckboxWidget
+from database import get_links_index, get_revisions_page
 from datatypes import CopyCookie
 from enumerates import Groups_Datatype
 from exceptions import ConsistencyError
 from fields import Char_Field, Datetime_Field, File_Field, HTMLFile_Field
+from fields import Integer_Field
 from fields import SelectAbspath_Field, Text_Field, Textarea_Field, UUID_Field
 from popup import DBResource_AddImage, DBResource_AddLink
 from popup import DBResource_AddMedia
@@ -57,7 +59,7 @@ from rest import Rest_Login, Rest_Schema, Rest_Query
 from rest import Rest_Create, Rest_Read, Rest_Update, Rest_Delete
 from revisions_views import DBResource_CommitLog, DBResource_Changes
 from update import class_version_to_date
-from utils import get_base_path_query, get_resource_by_uuid_query
+from utils import get_resource_by_uuid_query
 
 
 
@@ -96,6 +98,8 @@ class DBResource(Resource):
     ctime = Datetime_Field(indexed=True, stored=True, readonly=True)
     mtime = Datetime_Field(indexed=True, stored=True, readonly=True)
     last_author = Char_Field(indexed=False, stored=True, readonly=True)
+    # The last name given by make_resource_name
+    last_auto_name = Integer_Field(readonly=True)
     title = Text_Field(indexed=True, stored=True, title=MSG(u'Title'))
     description = Textarea_Field(indexed=True, title=MSG(u'Description'))
     subject = Text_Field(indexed=True, title=MSG(u'Keywords'))
@@ -233,17 +237,30 @@ class DBResource(Resource):
 
 
     def make_resource_name(self):
-        max_id = -1
-        for name in self.get_names():
-            # Mixing explicit and automatically generated names is allowed
-            try:
-                id = int(name)
-            except ValueError:
-                continue
-            if id > max_id:
-                max_id = id
+        # The last name given is kept in the metadata, the names are only
+        # scanned if it is missing
+        metadata = self.metadata
+        property = metadata.get_property('last_auto_name')
+        if property is not None:
+            max_id = property.value
+        else:
+            max_id = -1
+            for name in self.get_names():
+                try:
+                    id = int(name)
+                except ValueError:
+                    continue
+                if id > max_id:
+                    max_id = id
 
-        return str(max_id + 1)
+        # Mixing explicit and automatically generated names is allowed
+        id = max_id + 1
+        while self.get_resource(str(id), soft=True) is not None:
+            id += 1
+
+        # Without changing the resource itself (mtime, catalog)
+        metadata.set_property('last_auto_name', id)
+        return str(id)
 
 
     def make_resource(self, name, cls, soft=False, **kw):
@@ -291,22 +308,29 @@ class DBResource(Resource):
 
         # Referential action
         if ref_action == 'restrict':
-            # Check referencial-integrity
-            path = str(resource.abspath)
-            query = AndQuery(NotQuery(PhraseQuery('abspath', path)),
-                             NotQuery(get_base_path_query(path)))
-            sub_search = database.search(query)
-            for sub_resource in resource.traverse_resources():
-                path = str(sub_resource.abspath)
-                query = PhraseQuery('links', path)
-                results = sub_search.search(query)
-                # A resource may have been updated in the same transaction,
-                # so not yet reindexed: we need to check that the resource
-                # really links.
-                for referrer in results.get_resources():
-                    if path in referrer.get_links():
-                        err = 'cannot delete, resource "{}" is referenced'
-                        raise ConsistencyError(err.format(path))
+            # Check referencial-integrity, of the whole subtree at once
+            base = str(resource.abspath)
+            prefix = '%s/' % base
+            is_inside = lambda x: x == base or x.startswith(prefix)
+            err = 'cannot delete, resource "{}" is referenced'
+            old2new = database.resources_old2new
+            # 1. The links committed, from the links index (the resources
+            # changed in this transaction may not link anymore)
+            links_index = get_links_index(database)
+            for target in links_index.get_paths(base):
+                for source in links_index.get_sources(target):
+                    if not is_inside(source) and source not in old2new:
+                        raise ConsistencyError(err.format(target))
+            # 2. The links of the resources changed in this transaction
+            for path in database.resources_new2old:
+                if is_inside(path):
+                    continue
+                referrer = database.get_resource(path, soft=True)
+                if referrer is None:
+                    continue
+                for link in referrer.get_links():
+                    if is_inside(link):
+                        raise ConsistencyError(err.format(link))
         elif ref_action == 'force':
             # Do not check referencial-integrity
             pass
@@ -553,6 +577,20 @@ class DBResource(Resource):
         return worktree.git_log(files, n, author_pattern, grep_pattern)
 
 
+    def get_revisions_page(self, start=0, size=None, content=False,
+                           author_pattern=None, grep_pattern=None):
+        """Like 'get_revisions', but return only the revisions from 'start'
+        to 'start + size', and before them the number of revisions.
+        """
+        if self.parent is None and content is True:
+            files = None
+        else:
+            files = self.get_files_to_archive(content)
+
+        return get_revisions_page(self.database, files, start, size,
+                                  author_pattern, grep_pattern)
+
+
     def get_owner(self):
         return self.get_value('owner')
 
@@ -699,10 +737,7 @@ class DBResource(Resource):
         # (2) Update resources that link to me
         database = self.database
         target = self.abspath
-        query = PhraseQuery('links', source)
-        results = database.search(query).get_documents()
-        for result in results:
-            path = result.abspath
+        for path in sorted(get_links_index(database).get_sources(source)):
             path = database.resources_old2new.get(path, path)
             resource = self.get_resource(path)
             resource.update_links(source, target)
@@ -941,7 +976,8 @@ register_field('base_classes', String(multiple=True, indexed=True))
 register_field('class_version', Date(indexed=True, stored=True))
 # Referential integrity
 register_field('links', String(multiple=True, indexed=True))
-register_field('onchange_reindex', String(multiple=True, indexed=True))
+register_field('onchange_reindex',
+               String(multiple=True, indexed=True, stored=True))
 # Full text search
 register_field('text', Unicode(indexed=True))
 # Various classifications
@@ -33,10 +33,12 @@ from itools.web import Conflict, NotFound, NotImplemented
 # Import from ikaaro
 from autoform import AutoForm
 from buttons import Remove_Button
+from database import get_links_index
 from emails import send_email
 from exceptions import ConsistencyError
 from folder_views import Folder_BrowseContent
 from messages import MSG_LOGIN_WRONG_NAME_OR_PASSWORD
+from utils import get_etag, is_not_modified
 
 
 
@@ -111,10 +113,83 @@ class DBResource_GetFile(BaseView):
         return '%s.%s%s%s' % (resource.name, field_name, language, extension)
 
 
+    def get_range(self, context, size, etag):
+        """Return the (start, end) byte range asked by the client, end
+        excluded; or None if the whole body is to be sent.  Only single
+        ranges are supported, multiple ranges get the whole body, as the
+        syntactically invalid ones.  The range returned is empty if it
+        cannot be satisfied.
+        """
+        value = context.get_header('Range')
+        if not value or not value.startswith('bytes='):
+            return None
+        # The range is ignored if the client's copy is outdated
+        if_range = context.get_header('If-Range')
+        if if_range and if_range != etag:
+            return None
+
+        value = value[6:].strip()
+        if ',' in value:
+            return None
+        start, kk, end = value.partition('-')
+        try:
+            if start:
+                start = int(start)
+                if end:
+                    end = int(end) + 1
+                    # Invalid, the last byte is before the first one
+                    if end <= start:
+                        return None
+                else:
+                    end = size
+            else:
+                start = size - int(end)
+                end = size
+        except ValueError:
+            return None
+        return max(start, 0), min(end, size)
+
+
+    def get_body(self, handler, start=0, end=None):
+        """Return the body, or a range of it.  The data is read from the
+        file, if the handler has not been modified, so it is not loaded.
+        """
+        fs = self.context.database.fs
+        key = handler.key
+        if key and not handler.dirty and fs.exists(key):
+            with fs.open(key) as file:
+                file.seek(start)
+                if end is None:
+                    return file.read()
+                return file.read(end - start)
+
+        data = handler.to_str()
+        return data[start:end]
+
+
+    def get_size(self, handler):
+        fs = self.context.database.fs
+        key = handler.key
+        if key and not handler.dirty and fs.exists(key):
+            return fs.get_size(key)
+        return len(handler.to_str())
+
+
     def GET(self, resource, context):
         language = context.query['language']
         field_name = self.get_field_name(context)
         handler = self.get_handler(resource, field_name, language)
+        if handler is None:
+            raise NotFound
+
+        # Check the client's cache
+        mtime = handler.get_mtime()
+        size = self.get_size(handler)
+        etag = get_etag(handler.key, mtime, size)
+        if is_not_modified(context, mtime, etag):
+            context.status = 304
+            return ''
+
         # Content-Type
         content_type = self.get_content_type(handler)
         context.set_content_type(content_type)
@@ -122,8 +197,22 @@ class DBResource_GetFile(BaseView):
         disposition = 'attachment'
         filename = self.get_filename(handler, field_name, resource)
         context.set_content_disposition(disposition, filename)
-        # Ok
-        return handler.to_str()
+
+        # Range
+        context.set_header('Accept-Ranges', 'bytes')
+        byte_range = self.get_range(context, size, etag)
+        if byte_range is None:
+            return self.get_body(handler)
+
+        start, end = byte_range
+        if start >= end:
+            context.status = 416
+            context.set_header('Content-Range', 'bytes */%d' % size)
+            return ''
+        context.status = 206
+        context.set_header('Content-Range',
+                           'bytes %d-%d/%d' % (start, end - 1, size))
+        return self.get_body(handler, start, end)
 
 
 
@@ -152,11 +241,30 @@ class DBResource_GetImage(DBResource_GetFile):
         format = 'jpeg'
         if lossy is False:
             format = handler.get_mimetype().split('/')[1]
-        data, format = handler.get_thumbnail(width, height, format, fit)
+
+        # Check the client's cache
+        mtime = handler.get_mtime()
+        key = (handler.key, mtime, width, height, format, fit, lossy)
+        etag = get_etag(*key)
+        if is_not_modified(context, mtime, etag):
+            context.status = 304
+            return ''
+
+        # Check the server's cache (the modification time is part of the
+        # key, so the thumbnails of a changed image are not used anymore)
+        server = context.server
+        cache = server.thumbnails if server is not None else None
+        data = cache.get(key) if cache is not None else None
         if data is None:
-            default = context.get_template('/ui/ikaaro/icons/48x48/image.png')
-            data = default.to_str()
-            format = 'png'
+            data, format = handler.get_thumbnail(width, height, format, fit)
+            if data is None:
+                path = '/ui/ikaaro/icons/48x48/image.png'
+                data = context.get_template(path).to_str()
+                format = 'png'
+            elif cache is not None:
+                cache.set(key, '%s\n%s' % (format, data))
+        else:
+            format, data = data.split('\n', 1)
 
         # Headers
         context.set_content_type('image/%s' % format)
@@ -204,7 +312,10 @@ class DBResource_Backlinks(DBResource_Links):
     title = MSG(u"Backlinks")
 
     def get_items(self, resource, context):
-        return context.search(links=str(resource.abspath))
+        links_index = get_links_index(context.database)
+        sources = links_index.get_sources(resource.abspath)
+        query = OrQuery(*[ PhraseQuery('abspath', x) for x in sources ])
+        return context.search(query)
 
 
 
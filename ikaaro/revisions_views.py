@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from standard library
+from cPickle import dumps, loads
 from re import compile
 
 # Import from itools
@@ -124,6 +125,25 @@ def get_older_state(resource, revision, context):
 
 
 
+def get_diff_cache_key(worktree, revision, to):
+    """Return the key of the diff between the given revisions in the cache
+    of the server, made of the SHAs of the commits (None if a revision is
+    not found).
+    """
+    key = []
+    for reference in revision, to:
+        if reference is None:
+            key.append(None)
+            continue
+        try:
+            commit = worktree.repo.revparse_single(reference)
+        except (KeyError, ValueError):
+            return None
+        key.append(commit.hex)
+    return tuple(key)
+
+
+
 class IndexRevision(String):
 
     @staticmethod
@@ -147,6 +167,22 @@ class DiffButton(Button):
 
 
 
+class RevisionsPage(object):
+    """The revisions shown by the commit log: 'len' is the number of all
+    the revisions, for the batch control.
+    """
+
+    def __init__(self, total, start, items):
+        self.total = total
+        self.start = start
+        self.items = items
+
+
+    def __len__(self):
+        return self.total
+
+
+
 class DBResource_CommitLog(BrowseForm):
 
     access = 'is_allowed_to_edit'
@@ -172,21 +208,21 @@ class DBResource_CommitLog(BrowseForm):
         author_pattern = author_pattern if author_pattern else None
         grep_pattern = context.query['search_comment'].strip()
         grep_pattern = grep_pattern if grep_pattern else None
-        return resource.get_revisions(content=True,
-                                      author_pattern=author_pattern,
-                                      grep_pattern=grep_pattern)
+        # Only the revisions shown
+        start = context.query['batch_start']
+        size = context.query['batch_size']
+        total, items = resource.get_revisions_page(
+            start, size, content=True, author_pattern=author_pattern,
+            grep_pattern=grep_pattern)
+        return RevisionsPage(total, start, items)
 
 
     def sort_and_batch(self, resource, context, results):
         root = context.root
-        start = context.query['batch_start']
-        size = context.query['batch_size']
-
-        result = results[start:start+size]
 
-        # Add username / index by only for the showed commits
+        # Add username / index only for the showed commits
         users_cache = {}
-        for i, item in enumerate(results):
+        for i, item in enumerate(results.items):
             try:
                 author_name = str(item['author_name'])
             except UnicodeEncodeError:
@@ -198,9 +234,9 @@ class DBResource_CommitLog(BrowseForm):
                 users_cache[author_name] = username
             item['username'] = username
             # Used for keeping revisions order
-            item['index'] = i
+            item['index'] = results.start + i
 
-        return result
+        return results.items
 
 
     def get_item_value(self, resource, context, item, column):
@@ -243,33 +279,54 @@ class DBResource_Changes(STLView):
         root = context.root
         worktree = context.database.worktree
 
+        # Check the server's cache (commits do not change, but the
+        # references do, so the key is made of the SHAs)
+        cache = getattr(context.server, 'diffs', None)
+        key = data = None
+        if cache is not None:
+            key = get_diff_cache_key(worktree, revision, to)
+            if key is not None:
+                data = cache.get(key)
+
         if to is None:
             # Case 1: show one commit
-            try:
-                diff = worktree.git_diff(revision)
-            except EnvironmentError, e:
-                error = unicode(str(e), 'utf_8')
-                context.message = ERROR(u"Git failed: {error}", error=error)
-                return {'metadata': None, 'stat': None, 'changes': None}
+            if data is None:
+                try:
+                    diff = worktree.git_diff(revision)
+                except EnvironmentError, e:
+                    error = unicode(str(e), 'utf_8')
+                    context.message = ERROR(u"Git failed: {error}",
+                                            error=error)
+                    return {'metadata': None, 'stat': None, 'changes': None}
+                stat = worktree.git_stats(revision)
 
             metadata = worktree.get_metadata()
             author_name = metadata['author_name']
             metadata['author_name'] = root.get_user_title(author_name)
-            stat = worktree.git_stats(revision)
         else:
             # Case 2: show a set of commits
             metadata = None
-            # Get the list of files affected in this series
-            files = worktree.get_files_changed(revision, to)
-            # Get the statistic for these files
-            # Starting revision is included in the diff
-            revision = "%s^" % revision
-            stat = worktree.git_stats(revision, to, paths=files)
-            # Reuse the list of files to limit diff produced
-            diff = worktree.git_diff(revision, to, paths=files)
+            if data is None:
+                # Get the list of files affected in this series
+                files = worktree.get_files_changed(revision, to)
+                # Get the statistic for these files
+                # Starting revision is included in the diff
+                revision = "%s^" % revision
+                stat = worktree.git_stats(revision, to, paths=files)
+                # Reuse the list of files to limit diff produced
+                diff = worktree.git_diff(revision, to, paths=files)
+
+        # The rendered diff (the passwords are hidden)
+        if data is None:
+            stat = get_colored_stat(stat)
+            changes = get_colored_diff(diff)
+            if key is not None:
+                cache.set(key, dumps((stat, changes), 2))
+        else:
+            stat, changes = loads(data)
 
         # Ok
         return {
             'metadata': metadata,
-            'stat': get_colored_stat(stat),
-            'changes': get_colored_diff(diff)}
+            'stat': stat,
+            'changes': changes}
@@ -491,6 +491,12 @@ class Root(Folder):
         return access.has_permission(user, permission, resource, class_id)
 
 
+    def get_allowed_paths(self, user, permission, resources, class_id=None):
+        access = self.get_resource('config/access')
+        return access.get_allowed_paths(user, permission, resources,
+                                        class_id)
+
+
     def is_allowed_to_view(self, user, resource):
         return self.has_permission(user, 'view', resource)
 
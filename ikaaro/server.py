@@ -20,20 +20,19 @@
 
 # Import from the Standard Library
 from datetime import timedelta
-from email.parser import HeaderParser
 import inspect
+from itertools import imap
 import json
+from multiprocessing import Pool
 import pickle
-from os import fdopen, getpgid, getpid, kill, mkdir, remove
-from os.path import join
-from psutil import pid_exists
+from os import getpgid, getpid, kill, mkdir, remove, walk
+from os.path import dirname, join
+from psutil import Process, pid_exists
 import sys
 from time import time
 from traceback import format_exc
-from smtplib import SMTP, SMTPRecipientsRefused, SMTPResponseException
 from signal import SIGINT, SIGTERM
-from socket import gaierror
-from tempfile import mkstemp
+from subprocess import CalledProcessError, check_output
 
 # Import from pygobject
 from glib import GError
@@ -41,14 +40,15 @@ from glib import GError
 # Import from itools
 from itools.core import become_daemon, get_abspath, vmsize
 from itools.database import Metadata, RangeQuery
-from itools.database import make_catalog, Resource, get_register_fields
-from itools.database import check_database
+from itools.database import Catalog, make_catalog, Resource
+from itools.database import get_register_fields
+from itools.database import check_database, RWDatabase
 from itools.datatypes import Boolean, Email, Integer, String, Tokens
 from itools.fs import vfs, lfs
 from itools.handlers import ConfigFile, ro_database
 from itools.log import Logger, register_logger
 from itools.log import DEBUG, INFO, WARNING, ERROR, FATAL
-from itools.log import log_error, log_warning, log_info
+from itools.log import log_error
 from itools.loop import Loop, cron
 from itools.uri import get_reference
 from itools.web import WebServer, WebLogger
@@ -58,12 +58,17 @@ from itools.web.static import StaticView
 
 # Import from ikaaro
 from context import CMSContext
-from database import get_database, make_database
+from database import get_database, make_database, get_onchange_reindex
+from database import get_head_sha, get_catalog_watermark
+from database import set_catalog_watermark, load_links_index
+from database import register_commit_hook
 from datatypes import ExpireValue
 from root import Root
 from views import CachedStaticView
 from update import is_instance_up_to_date
-from skins import skin_registry
+from utils import DiskCache, PageCache
+from skins import Bundler, TemplateRegistry, skin_registry
+from spool import Spool
 
 
 
@@ -91,10 +96,21 @@ listen-port = {listen_port}
 # The "smtp-login" and "smtp-password" variables define the credentials
 # required to access a secured SMTP server.
 #
+# The "smtp-batch-size" variable defines the number of emails sent at once,
+# over the same connection (the default is 100).  When the emails are sent by
+# the web server a batch takes at most half a second, not to delay the
+# requests.
+#
+# If the "mail-worker" variable is true the emails are sent by the
+# icms-mailer.py script, the web server only adds them to the spool.  The
+# default is false.
+#
 smtp-host = {smtp_host}
 smtp-from = {smtp_from}
 smtp-login =
 smtp-password =
+smtp-batch-size = 100
+mail-worker = 0
 
 # The "log-level" variable may have one of these values (from lower to
 # higher verbosity): 'critical' 'error', 'warning', 'info' and 'debug'.
@@ -144,6 +160,26 @@ accept-cors = 0
 #
 max-width =
 max-height =
+
+# The "thumbnails-cache-size" variable defines the size, in megabytes, of the
+# on-disk cache of image thumbnails (the "cache/thumbnails" folder). Set it
+# to 0 to disable the cache (default is 100).
+#
+thumbnails-cache-size = 100
+
+# The "diffs-cache-size" variable defines the size, in megabytes, of the
+# on-disk cache of the changes shown by the commit log (the "cache/diffs"
+# folder). Set it to 0 to disable the cache (default is 20).
+#
+diffs-cache-size = 20
+
+# The "page-cache-size" variable defines the size, in megabytes, of the
+# in-memory cache of the pages served to anonymous users. The cache is
+# emptied on every change to the database, and the pages expire after
+# "page-cache-ttl" seconds.  The default is 0, the cache is disabled.
+#
+page-cache-size = 0
+page-cache-ttl = 60
 """)
 
 
@@ -211,6 +247,112 @@ def get_fake_context(database, context_cls=CMSContext):
     return context
 
 
+###########################################################################
+# Catalog rebuild in shards
+###########################################################################
+def get_subtree_sizes(path):
+    """Returns a dict {abspath: number of descendants} of the resources in
+    the given database folder, counting their metadata files.
+    """
+    sizes = {}
+    n = len(path.rstrip('/'))
+    for dirpath, dirnames, filenames in walk(path):
+        # Skip the Git folder (and the metadata of the root)
+        dirnames[:] = [ x for x in dirnames if x[0] != '.' ]
+        count = len([ x for x in filenames
+                      if x[0] != '.' and x.endswith('.metadata') ])
+        abspath = dirpath[n:] or '/'
+        while True:
+            sizes[abspath] = sizes.get(abspath, 0) + count
+            if abspath == '/':
+                break
+            abspath = dirname(abspath)
+    return sizes
+
+
+def get_catalog_shards(resource, sizes, size_max):
+    """Splits the tree of resources in shards to be indexed independently,
+    of at most 'size_max' resources each (but for a single resource).
+    Yields tuples (abspath, recursive): a resource with too many descendants
+    makes a shard of its own, and its children are split again.
+    """
+    abspath = str(resource.abspath)
+    if 1 + sizes.get(abspath, 0) <= size_max:
+        yield abspath, True
+        return
+
+    yield abspath, False
+    for child in resource.get_resources():
+        for shard in get_catalog_shards(child, sizes, size_max):
+            yield shard
+
+
+# The server used by the workers (inherited from the parent process)
+reindex_server = None
+
+def get_shard_catalog_values(shard):
+    """Computes the catalog values of the resources in the given shard.
+    Returns a tuple (shard, values, errors), with errors a list of tuples
+    (abspath, traceback).
+    """
+    path, recursive = shard
+    database = reindex_server.database
+    context = get_context()
+
+    values = []
+    errors = []
+    resource = database.get_resource(path)
+    resources = resource.traverse_resources() if recursive else [resource]
+    for obj in resources:
+        if not isinstance(obj, Resource):
+            continue
+        context.resource = obj
+        try:
+            values.append(obj.get_catalog_values())
+        except Exception:
+            errors.append((str(obj.abspath), format_exc()))
+        # Free Memory
+        del obj
+        database.make_room()
+
+    return shard, values, errors
+
+
+def get_rss():
+    """Returns the resident memory, in Kb, of this process and its
+    children (the workers).
+    """
+    process = Process(getpid())
+    rss = process.memory_info().rss
+    for child in process.children():
+        rss += child.memory_info().rss
+    return rss / 1024
+
+
+
+def get_file_resource_path(database, name):
+    """Returns the absolute path of the resource the given file (relative to
+    the database folder) belongs to.  Returns None if it cannot be found out,
+    e.g. a file of a removed resource (its metadata file tells it).
+    """
+    if name[-9:] == '.metadata':
+        return '/%s' % name[:-9]
+
+    # An attached file, named after the resource and the field
+    if '/' in name:
+        folder, base = name.rsplit('/', 1)
+    else:
+        folder, base = '', name
+    while '.' in base:
+        base = base.rsplit('.', 1)[0]
+        path = '/%s/%s' % (folder, base) if folder else '/%s' % base
+        if database.get_resource(path, soft=True) is not None:
+            return path
+
+    return None
+
+
+
 def create_server(target, email, password, root,  modules,
                   listen_port='8080', smtp_host='localhost', log_email=None):
     # Get modules
@@ -366,16 +508,42 @@ class Server(WebServer):
 
         # Email service
         self.spool = lfs.resolve2(self.target, 'spool')
-        spool_failed = '%s/failed' % self.spool
-        if not lfs.exists(spool_failed):
-            lfs.make_folder(spool_failed)
         # Configuration variables
         get_value = config.get_value
         self.smtp_host = get_value('smtp-host')
         self.smtp_login = get_value('smtp-login', default='').strip()
         self.smtp_password = get_value('smtp-password', default='').strip()
-        # Email is sent asynchronously
+        # Email is sent asynchronously, by batches (by another process with
+        # "mail-worker")
+        self.mail_worker = get_value('mail-worker')
+        self.mail_spool = Spool(self.spool, self.smtp_host, self.smtp_login,
+                                self.smtp_password,
+                                get_value('smtp-batch-size'),
+                                None if self.mail_worker else 0.5)
+        self.spool_scheduled = False
         self.flush_spool()
+        # Thumbnails
+        size = get_value('thumbnails-cache-size')
+        if size:
+            path = '%s/cache/thumbnails' % target
+            self.thumbnails = DiskCache(path, size * 1024 * 1024)
+        else:
+            self.thumbnails = None
+        # Diffs
+        size = get_value('diffs-cache-size')
+        if size:
+            path = '%s/cache/diffs' % target
+            self.diffs = DiskCache(path, size * 1024 * 1024)
+        else:
+            self.diffs = None
+        # Pages served to anonymous users
+        size = get_value('page-cache-size')
+        if size:
+            ttl = get_value('page-cache-ttl')
+            self.page_cache = PageCache(size * 1024 * 1024, ttl)
+            register_commit_hook(self.page_cache.clear)
+        else:
+            self.page_cache = None
 
         # Logging
         log_file = '%s/log/events' % target
@@ -390,6 +558,15 @@ class Server(WebServer):
         register_logger(logger, 'itools.web')
         # Session timeout
         self.session_timeout = get_value('session-timeout')
+        # Bundles of the skins' styles and scripts (not in development, the
+        # files are changed as we work)
+        if self.is_development_environment():
+            self.bundler = None
+        else:
+            self.bundler = Bundler('%s/cache/bundles' % target)
+        # Index of the templates of the skins (watch the files in
+        # development)
+        self.templates = TemplateRegistry(self.is_development_environment())
         # Register routes
         self.register_dispatch_routes()
 
@@ -428,6 +605,16 @@ class Server(WebServer):
         # Update Git tree-cache, to speed things up
         self.database.worktree.update_tree_cache()
 
+        # Load the links index (built and written in read-write mode only)
+        database = self.database
+        load_links_index(database, save=isinstance(database, RWDatabase))
+
+        # Build the bundles of the skins
+        if self.bundler:
+            self.bundler.build()
+        # Index and parse the templates of the skins
+        self.templates.build(self)
+
         # Find out the IP to listen to
         address = self.config.get_value('listen-address').strip()
         if not address:
@@ -463,18 +650,24 @@ class Server(WebServer):
         return True
 
 
-    def reindex_catalog(self, quiet=False, quick=False, as_test=False):
+    def reindex_catalog(self, quiet=False, quick=False, as_test=False,
+                        processes=1, resume=False, shard_size=1000):
         if self.is_running_in_rw_mode():
             print 'Cannot proceed, the server is running in read-write mode.'
             return
         # Check for database consistency
         if quick is False and check_database(self.target) is False:
             return False
+        # Rebuild in shards
+        if processes > 1 or resume:
+            return self._reindex_catalog_in_shards(quiet, as_test, processes,
+                                                   resume, shard_size)
         # Create a temporary new catalog
         catalog_path = '%s/catalog.new' % self.target
         if lfs.exists(catalog_path):
             lfs.remove(catalog_path)
         catalog = make_catalog(catalog_path, get_register_fields())
+        watermark = get_head_sha(self.database)
 
         # Get the root
         root = self.root
@@ -531,6 +724,8 @@ class Server(WebServer):
             if lfs.exists(old_catalog_path):
                 lfs.remove(old_catalog_path)
             lfs.move(catalog_path, old_catalog_path)
+            set_catalog_watermark(self.target, watermark)
+            self.build_links_index()
             # Commit / Report
             t2, v2 = time(), vmsize()
             v = (v2 - v1)/1024
@@ -543,6 +738,229 @@ class Server(WebServer):
             return False
 
 
+    def _reindex_catalog_in_shards(self, quiet, as_test, processes, resume,
+                                   shard_size, commit_every=10000):
+        """Rebuilds the catalog splitting the tree in shards of at most
+        'shard_size' resources, whose catalog values are computed by a pool
+        of worker processes.  The shards indexed are recorded in a
+        checkpoint file every time the new catalog is saved (every
+        'commit_every' documents), so an interrupted rebuild can be resumed.
+        """
+        global reindex_server
+
+        target = self.target
+        catalog_path = '%s/catalog.new' % target
+        checkpoint_path = '%s/catalog.new.checkpoint' % target
+        log_path = '%s/log/update-catalog' % target
+
+        # The shards already indexed
+        done = set()
+        resume = (resume and lfs.exists(catalog_path)
+                  and lfs.exists(checkpoint_path))
+        if resume:
+            with open(checkpoint_path) as file:
+                for line in file:
+                    path, recursive = line.split()
+                    done.add((path, recursive == '1'))
+            print '[Update] Resuming, %d shards already indexed' % len(done)
+
+        watermark = get_head_sha(self.database)
+
+        # Build a fake context (inherited by the workers)
+        context = self.get_fake_context()
+
+        # The shards to index
+        sizes = get_subtree_sizes('%s/database' % target)
+        shards = get_catalog_shards(self.root, sizes, shard_size)
+        shards = [ x for x in shards if x not in done ]
+        print '[Update] %d shards to index' % len(shards)
+
+        # Start the workers, before the new catalog is open (they must not
+        # inherit it)
+        reindex_server = self
+        pool = Pool(processes) if processes > 1 else None
+
+        t0, v0 = time(), vmsize()
+        t_report = t0
+        doc_n = doc_checkpoint = 0
+        pending = []
+        error_detected = False
+        if as_test:
+            log = open(log_path, 'w').write
+        try:
+            # Open or create the new catalog
+            if resume:
+                catalog = Catalog(catalog_path, get_register_fields())
+            else:
+                if lfs.exists(catalog_path):
+                    lfs.remove(catalog_path)
+                catalog = make_catalog(catalog_path, get_register_fields())
+                open(checkpoint_path, 'w').close()
+
+            # Go
+            if pool is not None:
+                results = pool.imap_unordered(get_shard_catalog_values,
+                                              shards)
+            else:
+                results = imap(get_shard_catalog_values, shards)
+            for shard, values, errors in results:
+                # Errors
+                for abspath, details in errors:
+                    if not as_test:
+                        raise RuntimeError(details)
+                    error_detected = True
+                    log('*** Error detected ***\n')
+                    log('Abspath of the resource: %r\n\n' % abspath)
+                    log(details)
+                    log('\n')
+
+                # Index
+                for doc_values in values:
+                    abspath = doc_values['abspath']
+                    if not quiet:
+                        print doc_n, abspath
+                    if resume:
+                        # The document may be there from a previous run
+                        catalog.unindex_document(abspath)
+                    catalog.index_document(doc_values)
+                    doc_n += 1
+                pending.append(shard)
+
+                # Checkpoint
+                if doc_n - doc_checkpoint >= commit_every:
+                    catalog.save_changes()
+                    with open(checkpoint_path, 'a') as file:
+                        for path, recursive in pending:
+                            file.write('%s %d\n' % (path, recursive))
+                    pending = []
+                    doc_checkpoint = doc_n
+
+                # Report throughput
+                t1 = time()
+                if t1 - t_report >= 10:
+                    t_report = t1
+                    print '[Update] %d docs, %.02f docs/s, RSS: %s Kb' % (
+                        doc_n, doc_n / (t1 - t0), get_rss())
+        except BaseException:
+            # Do not wait for the shards left (error or Ctrl-C)
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            raise
+        else:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        finally:
+            reindex_server = None
+
+        if error_detected:
+            print '[Update] Error(s) detected, the new catalog was NOT saved'
+            print '[Update] You can find more infos in %r' % log_path
+            return False
+
+        if as_test:
+            # Delete the empty log file
+            remove(log_path)
+
+        # Update / Report
+        t1, v1 = time(), vmsize()
+        v = (v1 - v0)/1024
+        print '[Update] Time: %.02f seconds. Memory: %s Kb' % (t1 - t0, v)
+        if t1 > t0:
+            print '[Update] %d docs, %.02f docs/s' % (doc_n, doc_n / (t1 - t0))
+        # Commit
+        print '[Commit]',
+        sys.stdout.flush()
+        catalog.save_changes()
+        # Commit / Replace
+        old_catalog_path = '%s/catalog' % target
+        if lfs.exists(old_catalog_path):
+            lfs.remove(old_catalog_path)
+        lfs.move(catalog_path, old_catalog_path)
+        lfs.remove(checkpoint_path)
+        set_catalog_watermark(target, watermark)
+        self.build_links_index()
+        # Commit / Report
+        t2, v2 = time(), vmsize()
+        v = (v2 - v1)/1024
+        print 'Time: %.02f seconds. Memory: %s Kb' % (t2 - t1, v)
+        return True
+
+
+    def update_catalog(self, since=None, quiet=False):
+        """Updates the catalog with the changes done in the database since
+        the given commit (by default the commit the catalog is known to be
+        up-to-date with), instead of rebuilding it.
+        """
+        if self.is_running_in_rw_mode():
+            print 'Cannot proceed, the server is running in read-write mode.'
+            return
+        target = self.target
+        database = self.database
+        if since is None:
+            since = get_catalog_watermark(target)
+            if since is None:
+                print '[Update] The catalog watermark is missing, rebuild it'
+                return False
+
+        # Find out the resources changed since the given commit
+        t0 = time()
+        watermark = get_head_sha(database)
+        command = ['git', 'diff', '--name-only', '--no-renames', since,
+                   watermark]
+        try:
+            names = check_output(command, cwd='%s/database' % target)
+        except CalledProcessError:
+            # Unknown commit (e.g. the history was rewritten)
+            print '[Update] Unknown commit %s, rebuild the catalog' % since
+            return False
+        changed = set()
+        for name in names.splitlines():
+            path = get_file_resource_path(database, name)
+            if path is not None:
+                changed.add(path)
+        # And those that depend on them
+        changed.update(get_onchange_reindex(database, changed))
+        print '[Update] %d resources changed since %s' % (len(changed), since)
+
+        # Update
+        catalog = Catalog('%s/catalog' % target, get_register_fields())
+        context = self.get_fake_context()
+        doc_n = 0
+        for path in sorted(changed):
+            catalog.unindex_document(path)
+            resource = database.get_resource(path, soft=True)
+            if not isinstance(resource, Resource):
+                continue
+            if not quiet:
+                print doc_n, path
+            context.resource = resource
+            catalog.index_document(resource.get_catalog_values())
+            doc_n += 1
+            database.make_room()
+
+        # Commit
+        catalog.save_changes()
+        catalog.close()
+        set_catalog_watermark(target, watermark)
+        # Rebuild the links index from the updated catalog
+        self.build_links_index()
+        print '[Update] Time: %.02f seconds, %d docs indexed' % (time() - t0,
+                                                                 doc_n)
+        return True
+
+
+    def build_links_index(self):
+        """Builds the links index from the catalog, once it has been
+        rebuilt or updated.
+        """
+        # Search the new catalog
+        database = self.database
+        database.catalog = database.get_catalog()
+        load_links_index(database, save=True)
+
+
     def get_pid(self):
         return get_pid('%s/pid' % self.target)
 
@@ -624,9 +1042,10 @@ class Server(WebServer):
     # Mailing
     #######################################################################
     def get_spool_size(self):
-        spool = lfs.open(self.spool)
-        # We have always a 'failed' directory => "-1"
-        return len(spool.get_names()) - 1
+        # Sent by icms-mailer.py, our queue is not emptied
+        if self.mail_worker:
+            return len(self.mail_spool.get_names())
+        return self.mail_spool.get_size()
 
 
     def save_email(self, message):
@@ -634,17 +1053,23 @@ class Server(WebServer):
         if not self.smtp_host:
             raise ValueError, '"smtp-host" is not set in config.conf'
 
-        spool = lfs.resolve2(self.target, 'spool')
-        tmp_file, tmp_path = mkstemp(dir=spool)
-        file = fdopen(tmp_file, 'w')
-        try:
-            file.write(message.as_string())
-        finally:
-            file.close()
+        self.mail_spool.add(message.as_string())
+
+
+    def get_spool_stats(self):
+        if self.mail_worker:
+            return self.mail_spool.load_stats()
+        return self.mail_spool.get_stats()
 
 
     def flush_spool(self):
-        cron(self._smtp_send, timedelta(seconds=1))
+        # Sent by icms-mailer.py
+        if self.mail_worker:
+            return
+
+        if not self.spool_scheduled:
+            self.spool_scheduled = True
+            cron(self._smtp_send, timedelta(seconds=1))
 
 
     def send_email(self, message):
@@ -653,78 +1078,10 @@ class Server(WebServer):
 
 
     def _smtp_send(self):
-        nb_max_mails_to_send = 2
-        spool = lfs.open(self.spool)
-
-        def get_names():
-            # Find out emails to send
-            locks = set()
-            names = set()
-            for name in spool.get_names():
-                if name == 'failed':
-                    # Skip "failed" special directory
-                    continue
-                if name[-5:] == '.lock':
-                    locks.add(name[:-5])
-                else:
-                    names.add(name)
-            names.difference_update(locks)
-            return names
-
-        # Send emails
-        names = get_names()
-        smtp_host = self.smtp_host
-        for name in list(names)[:nb_max_mails_to_send]:
-            # 1. Open connection
-            try:
-                smtp = SMTP(smtp_host)
-            except gaierror, excp:
-                log_warning('%s: "%s"' % (excp[1], smtp_host))
-                return 60 # 1 minute
-            except Exception:
-                self.smtp_log_error()
-                return 60 # 1 minute
-            log_info('CONNECTED to %s' % smtp_host)
-
-            # 2. Login
-            if self.smtp_login and self.smtp_password:
-                smtp.login(self.smtp_login, self.smtp_password)
-
-            # 3. Send message
-            try:
-                message = spool.open(name).read()
-                headers = HeaderParser().parsestr(message)
-                subject = headers['subject']
-                from_addr = headers['from']
-                to_addr = headers['to']
-                smtp.sendmail(from_addr, to_addr, message)
-                # Remove
-                spool.remove(name)
-                # Log
-                log_msg = 'Email "%s" sent from "%s" to "%s"'
-                log_info(log_msg % (subject, from_addr, to_addr))
-            except SMTPRecipientsRefused:
-                # The recipient addresses has been refused
-                self.smtp_log_error()
-                spool.move(name, 'failed/%s' % name)
-            except SMTPResponseException, excp:
-                # The SMTP server returns an error code
-                self.smtp_log_error()
-                spool.move(name, 'failed/%s_%s' % (excp.smtp_code, name))
-            except Exception:
-                self.smtp_log_error()
-
-            # 4. Close connection
-            smtp.quit()
-
-        # Is there something left?
-        return 60 if get_names() else False
-
-
-    def smtp_log_error(self):
-        summary = 'Error sending email\n'
-        details = format_exc()
-        log_error(summary + details)
+        delay = self.mail_spool.send()
+        if not delay:
+            self.spool_scheduled = False
+        return delay
 
 
     def register_dispatch_routes(self):
@@ -743,6 +1100,12 @@ class Server(WebServer):
             mount_path = '/ui/cached/%s/%s' % (ts, name)
             view = CachedStaticView(local_path=skin_key, mount_path=mount_path)
             self.dispatcher.add('/ui/cached/%s/%s/{name:any}' % (ts, name), view)
+        # Bundles
+        if self.bundler:
+            bundler = self.bundler
+            view = CachedStaticView(local_path=bundler.path,
+                                    mount_path=bundler.mount_path)
+            self.dispatcher.add('%s/{name:any}' % bundler.mount_path, view)
 
 
     def register_urlpatterns_from_package(self, package):
@@ -816,6 +1179,8 @@ class ServerConfig(ConfigFile):
         'smtp-from': String(default=''),
         'smtp-login': String(default=''),
         'smtp-password': String(default=''),
+        'smtp-batch-size': Integer(default=100),
+        'mail-worker': Boolean(default=False),
         # Logging
         'log-level': String(default='warning'),
         'log-email': Email(default=''),
@@ -829,6 +1194,10 @@ class ServerConfig(ConfigFile):
         'index-text': Boolean(default=True),
         'max-width': Integer(default=None),
         'max-height': Integer(default=None),
+        'thumbnails-cache-size': Integer(default=100),
+        'diffs-cache-size': Integer(default=20),
+        'page-cache-size': Integer(default=0),
+        'page-cache-ttl': Integer(default=60),
     }
 
 
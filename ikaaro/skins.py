@@ -20,17 +20,30 @@
 
 # Import from the Standard Library
 from copy import deepcopy
-from os.path import isfile
+from hashlib import md5
+from os import listdir, makedirs, rename, walk
+from os.path import exists, getmtime, isdir, isfile, join, relpath
+from posixpath import dirname, normpath
+from re import compile as re_compile, DOTALL
+
+# Import from other modules
+try:
+    from jsmin import jsmin
+except ImportError:
+    jsmin = None
 
 # Import from itools
 from itools.core import get_abspath
 from itools.datatypes import Unicode
 from itools.fs import vfs
 from itools.gettext import MSG
+from itools.handlers import ro_database
+from itools.i18n import has_language
 from itools.stl import stl
 from itools.web import get_context, ERROR, INFO
 
 # Import from ikaaro
+from database import register_commit_hook
 from folder import Folder
 from views import get_view_scripts
 from skins_views import LanguagesTemplate, LocationTemplate
@@ -47,10 +60,30 @@ class Skin(object):
     location_template = LocationTemplate
 
 
+    # The files of the skin, see get_manifest
+    manifest = None
+
+
     def __init__(self, key):
         self.key = key
 
 
+    def get_manifest(self):
+        """Return the set of the files of the skin (relative paths), computed
+        once so we do not check the file system on every page.
+        """
+        if self.manifest is None:
+            manifest = set()
+            for dirpath, dirnames, filenames in walk(self.key):
+                dirpath = relpath(dirpath, self.key)
+                for filename in filenames:
+                    if dirpath != '.':
+                        filename = '%s/%s' % (dirpath, filename)
+                    manifest.add(filename)
+            self.manifest = manifest
+        return self.manifest
+
+
     def get_environment_key(self, server):
         """ In development environment we can use '/ui_dev/skin/' directory
         for skin (to avoid build JS/CSS at every changes)
@@ -93,14 +126,29 @@ class Skin(object):
                                 view_title=view_title)
 
 
-    def _get_theme_file(self, context, name):
-        theme = context.database.get_resource('/config/theme')
-        if context.root.is_allowed_to_view(context.user, theme):
-            value = theme.get_value(name)
-            if value:
-                return value
+    def get_theme_files(self, context):
+        """Return a dict with the files of the theme the user is allowed to
+        see: {'logo': bool, 'style': bool, 'favicon': <mimetype or None>}
+        """
+        # Cached per user (and groups, changing them changes the rights)
+        user = context.user
+        if user is None:
+            key = ('theme', None, frozenset())
+        else:
+            groups = frozenset(user.get_value('groups'))
+            key = ('theme', str(user.abspath), groups)
+        files = skin_fragments.get(key)
+        if files is not None:
+            return files
 
-        return None
+        theme = context.database.get_resource('/config/theme')
+        allowed = context.root.is_allowed_to_view(user, theme)
+        files = {}
+        for name in ['logo', 'style', 'favicon']:
+            value = theme.get_value(name) if allowed else None
+            files[name] = value.get_mimetype() if value else None
+        set_skin_fragment(key, files)
+        return files
 
 
     def get_styles(self, context):
@@ -108,7 +156,7 @@ class Skin(object):
         styles = ['/ui/ikaaro/bo.css']
 
         # Skin
-        if isfile('%s/style.css' % self.key):
+        if 'style.css' in self.get_manifest():
             styles.append('%s/style.css' % self.base_path)
 
         # View
@@ -120,12 +168,12 @@ class Skin(object):
         styles.extend(extra)
 
         # Database style
-        if self._get_theme_file(context, 'style'):
+        if self.get_theme_files(context)['style']:
             styles.append(
                 '/config/theme/;get_file?name=style&mimetype=text/css')
 
         # Ok
-        return styles
+        return get_bundles(context, styles, 'css')
 
 
     def get_scripts(self, context):
@@ -134,7 +182,7 @@ class Skin(object):
             '/ui/ikaaro/javascript.js']
 
         # This skin's JavaScript
-        if isfile('%s/javascript.js' % self.key):
+        if 'javascript.js' in self.get_manifest():
             scripts.append('%s/javascript.js' % self.base_path)
 
         # View
@@ -143,7 +191,7 @@ class Skin(object):
                 scripts.append(script)
 
         # Ok
-        return scripts
+        return get_bundles(context, scripts, 'js')
 
 
     def get_meta_tags(self, context):
@@ -202,10 +250,9 @@ class Skin(object):
 
     def get_favicon(self, context):
         # Case 1: from the database
-        favicon = self._get_theme_file(context, 'favicon')
-        if favicon:
+        favicon_type = self.get_theme_files(context)['favicon']
+        if favicon_type:
             favicon_href = '/config/theme/;get_file?name=favicon'
-            favicon_type = favicon.get_mimetype()
             return favicon_href, favicon_type
 
         # Case 2: from the skin
@@ -339,8 +386,28 @@ class Skin(object):
 
 
     def get_footer(self, context):
-        footer = context.root.get_resource('config/footer')
-        return footer.get_html_data()
+        # The languages of the footer
+        languages = skin_fragments.get('footer')
+        if languages is None:
+            footer = context.root.get_resource('config/footer')
+            languages = [
+                x for x in context.root.get_value('website_languages')
+                if footer.get_value('data', language=x) ]
+            set_skin_fragment('footer', languages)
+        if not languages:
+            return None
+
+        # The footer in the language of the user
+        language = context.accept_language.select_language(languages)
+        if language is None:
+            language = languages[0]
+        key = ('footer', language)
+        data = skin_fragments.get(key)
+        if data is None:
+            footer = context.root.get_resource('config/footer')
+            data = list(footer.get_html_data(language))
+            set_skin_fragment(key, data)
+        return data
 
 
     def get_menu_namespace(self, context):
@@ -360,7 +427,7 @@ class Skin(object):
         favicon_href, favicon_type = self.get_favicon(context)
 
         # Logo
-        logo = self._get_theme_file(context, 'logo')
+        logo = self.get_theme_files(context)['logo']
         logo_href = '/config/theme/;get_file?name=logo' if logo else None
 
         # The document language
@@ -469,3 +536,310 @@ register_skin('ikaaro', '%s/ikaaro' % ui_path)
 register_skin('aruni', '%s/aruni' % ui_path)
 register_skin('popup', '%s/popup' % ui_path)
 register_skin('fancybox', FancyboxSkin('%s/fancybox' % ui_path))
+
+
+
+#############################################################################
+# Templates
+#############################################################################
+class TemplateRegistry(object):
+    """Index of the files of the skins, to find the templates without asking
+    the file system on every request (see CMSContext.get_template).  Maps
+    the local path of a file to its handler, and the local path of a
+    template without its language extension to the available languages.
+
+    With "watch" (development) the folders are checked for new or removed
+    files, and the handlers are asked to the database which reloads them
+    when they change.
+    """
+
+    def __init__(self, watch=False):
+        self.watch = watch
+        # {folder: mtime}
+        self.folders = {}
+        # {local path: handler}
+        self.handlers = {}
+        # {local path: [language, ...]}
+        self.languages = {}
+
+
+    def build(self, server=None):
+        """Index the folders of the skins and parse their templates.
+        """
+        for skin in skin_registry.values():
+            self.index(skin.key)
+            skin_key = skin.get_environment_key(server)
+            if skin_key != skin.key:
+                self.index(skin_key)
+
+        # Parse the templates
+        for key in self.handlers.keys():
+            name = key.rsplit('/', 1)[-1]
+            if name.endswith('.xhtml') or '.xml.' in name:
+                handler = self.get_handler(key)
+                if handler is not None and handler.timestamp is None:
+                    handler.load_state()
+
+
+    def index(self, skin_key):
+        skin_key = normpath(skin_key)
+        if skin_key in self.folders:
+            return
+        for dirpath, dirnames, filenames in walk(skin_key):
+            self.index_folder(dirpath, filenames)
+
+
+    def index_folder(self, folder, names):
+        self.folders[folder] = getmtime(folder)
+        for name in names:
+            key = '%s/%s' % (folder, name)
+            self.handlers[key] = None
+            # Language variants
+            stem, kk, language = name.rpartition('.')
+            if stem and has_language(language):
+                stem = '%s/%s' % (folder, stem)
+                self.languages.setdefault(stem, []).append(language)
+                self.languages[stem].sort()
+
+
+    def update_folder(self, folder):
+        """Index again the given folder if it has changed (development).
+        """
+        is_folder = isdir(folder)
+        mtime = self.folders.pop(folder, None)
+        if is_folder and mtime == getmtime(folder):
+            self.folders[folder] = mtime
+            return
+        if mtime is None and not is_folder:
+            return
+
+        # Forget the files of the folder
+        for index in self.handlers, self.languages:
+            for key in index.keys():
+                if dirname(key) == folder:
+                    del index[key]
+        # Index again
+        if is_folder:
+            names = [ x for x in listdir(folder) if isfile(join(folder, x)) ]
+            self.index_folder(folder, names)
+
+
+    def get_handler(self, key):
+        if self.watch:
+            return ro_database.get_handler(key, soft=True)
+
+        handler = self.handlers[key]
+        if handler is None:
+            handler = ro_database.get_handler(key, soft=True)
+            self.handlers[key] = handler
+        return handler
+
+
+    def get_template(self, skin_key, web_path, accept):
+        """Return the handler of the template or file at the given path of
+        the skin, negotiating the language variants.  Return None if there
+        is no such file.
+        """
+        self.index(skin_key)
+        local_path = normpath(skin_key + web_path)
+        if self.watch:
+            self.update_folder(dirname(local_path))
+
+        # Exact match
+        if local_path in self.handlers:
+            return self.get_handler(local_path)
+
+        # Language negotiation
+        languages = self.languages.get(local_path)
+        if not languages:
+            return None
+        language = accept.select_language(languages)
+        # By default use whatever variant
+        # (XXX we need a way to define the default)
+        if language is None:
+            language = languages[0]
+        return self.get_handler('%s.%s' % (local_path, language))
+
+
+
+#############################################################################
+# Fragments
+#############################################################################
+# The parts of the skin namespace that only change with the theme or the
+# footer, shared by the requests (see Skin.get_theme_files and
+# Skin.get_footer).
+skin_fragments = {}
+
+def set_skin_fragment(key, value):
+    # The theme files are cached per user, keep it bounded
+    if len(skin_fragments) > 1000:
+        skin_fragments.clear()
+    skin_fragments[key] = value
+
+
+def clear_skin_fragments(paths):
+    # The root too, the footer depends on its 'website_languages'
+    prefixes = ('/config/footer', '/config/theme', '/config/access',
+                '/config/groups')
+    for path in paths:
+        if path == '/' or path.startswith(prefixes):
+            skin_fragments.clear()
+            return
+
+register_commit_hook(clear_skin_fragments)
+
+
+
+#############################################################################
+# Bundles
+#############################################################################
+
+# These scripts load other files relative to their own URL, they cannot be
+# bundled
+not_bundled = ['/ui/ikaaro/tiny_mce/', '/ui/ikaaro/editarea/']
+
+css_comment = re_compile(r'/\*.*?\*/', DOTALL)
+css_space = re_compile(r'\s+')
+css_separator = re_compile(r' ?([{};,>]) ?')
+css_url = re_compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+def minify_css(data):
+    data = css_comment.sub('', data)
+    data = css_space.sub(' ', data)
+    data = css_separator.sub(r'\1', data)
+    return data.replace(';}', '}').strip()
+
+
+def minify_js(data):
+    if jsmin is None:
+        return data
+    return jsmin(data)
+
+
+
+class Bundler(object):
+    """Concatenate and minify the CSS and JavaScript files of the skins.
+    The bundles are written in the given folder, named after their content
+    so they can be cached forever by the clients.
+    """
+
+    def __init__(self, path, mount_path='/ui/bundles'):
+        self.path = path
+        self.mount_path = mount_path
+        # {(kind, url, ...): bundle url}
+        self.bundles = {}
+
+
+    def build(self):
+        """Build the bundles used by every page, the ones of the skins
+        alone.
+        """
+        if not exists(self.path):
+            makedirs(self.path)
+        for skin in skin_registry.values():
+            styles = ['/ui/ikaaro/bo.css']
+            if 'style.css' in skin.get_manifest():
+                styles.append('%s/style.css' % skin.base_path)
+            self.get_urls(styles, 'css')
+            scripts = ['/ui/ikaaro/jquery.js', '/ui/ikaaro/javascript.js']
+            if 'javascript.js' in skin.get_manifest():
+                scripts.append('%s/javascript.js' % skin.base_path)
+            self.get_urls(scripts, 'js')
+
+
+    def get_file(self, url):
+        """Return the local path of the file behind the given URL, if it is
+        a file of a skin that can be bundled.  Otherwise return None.
+        """
+        for prefix in not_bundled:
+            if url.startswith(prefix):
+                return None
+        if not url.startswith('/ui/') or '?' in url:
+            return None
+        name, kk, path = url[4:].partition('/')
+        skin = skin_registry.get(name)
+        if skin is None or path not in skin.get_manifest():
+            return None
+        return '%s/%s' % (skin.key, path)
+
+
+    def get_urls(self, urls, kind):
+        """Replace every sequence of files that can be bundled by their
+        bundle, keeping the order.
+        """
+        result = []
+        files = []
+        for url in urls:
+            if self.get_file(url):
+                files.append(url)
+                continue
+            if files:
+                result.append(self.get_bundle(files, kind))
+                files = []
+            result.append(url)
+        if files:
+            result.append(self.get_bundle(files, kind))
+        return result
+
+
+    def get_bundle(self, urls, kind):
+        key = (kind,) + tuple(urls)
+        bundle = self.bundles.get(key)
+        if bundle is not None:
+            return bundle
+
+        # Concatenate
+        data = []
+        for url in urls:
+            with open(self.get_file(url)) as file:
+                value = file.read()
+            if value.startswith('\xef\xbb\xbf'):
+                value = value[3:]
+            if kind == 'css':
+                value = self.fix_css_urls(url, value)
+                data.append(minify_css(value))
+            else:
+                data.append(minify_js(value))
+        separator = '\n' if kind == 'css' else '\n;\n'
+        data = separator.join(data)
+
+        # Write (atomic)
+        name = '%s.%s' % (md5(data).hexdigest(), kind)
+        path = join(self.path, name)
+        if not exists(path):
+            if not exists(self.path):
+                makedirs(self.path)
+            with open('%s.tmp' % path, 'w') as file:
+                file.write(data)
+            rename('%s.tmp' % path, path)
+
+        # Ok
+        bundle = '%s/%s' % (self.mount_path, name)
+        self.bundles[key] = bundle
+        return bundle
+
+
+    def fix_css_urls(self, url, data):
+        """The bundle is not in the same folder than the style sheet, so
+        relative references must be made absolute.
+        """
+        base = dirname(url)
+        def fix(match):
+            quote, reference = match.groups()
+            if reference.startswith(('/', '#')) or ':' in reference:
+                return match.group(0)
+            reference = normpath('%s/%s' % (base, reference))
+            return 'url(%s%s%s)' % (quote, reference, quote)
+        return css_url.sub(fix, data)
+
+
+
+def get_bundles(context, urls, kind):
+    """Return the given list of URLs, where the files of the skins are
+    replaced by their bundles; unless the server does not bundle them (like
+    in development environment).
+    """
+    bundler = getattr(context.server, 'bundler', None)
+    if bundler is None:
+        return urls
+    return bundler.get_urls(urls, kind)
@@ -0,0 +1,408 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from collections import deque
+from email.parser import HeaderParser
+import json
+from os import fdopen, getpid, listdir, makedirs, remove, rename
+from os.path import basename, exists, getmtime, getsize, join
+from smtplib import SMTP, SMTPException, SMTPRecipientsRefused
+from smtplib import SMTPResponseException
+from socket import error as socket_error, gaierror
+from tempfile import mkstemp
+from time import time
+from traceback import format_exc
+
+# Import from itools
+from itools.log import log_error, log_info, log_warning
+
+
+
+class Spool(object):
+    """The queue of the emails to send.  Every email is a file in the spool
+    folder, and its name is appended to the "queue" index file, so the
+    emails to send are found without listing the folder.  The emails
+    refused by the SMTP server are moved to the "failed" folder.
+
+    The emails are sent by batches, over one SMTP connection kept open
+    while there are emails to send.  After an error the next batch is
+    delayed, the delay doubles with every consecutive error of the same
+    kind.
+    """
+
+    index_name = 'queue'
+    # Written by the mail worker, see scripts/icms-mailer.py
+    stats_name = 'stats.json'
+    # Empty the index once it is this big (bytes) and everything is sent
+    index_size_max = 64 * 1024
+    # The delay before trying again after an error (seconds)
+    backoff_min = 60
+    backoff_max = 3600
+    # An email failing this many times is moved to the "failed" folder
+    attempts_max = 5
+
+
+    def __init__(self, path, smtp_host, smtp_login='', smtp_password='',
+                 batch_size=100, time_max=None):
+        self.path = path
+        self.index = join(path, self.index_name)
+        self.smtp_host = smtp_host
+        self.smtp_login = smtp_login
+        self.smtp_password = smtp_password
+        self.batch_size = batch_size
+        # Stop the batch after this many seconds (None: no limit)
+        self.time_max = time_max
+        # The emails to send
+        self.queue = deque()
+        self.queued = set()
+        # How much of the index has been read (None: not yet)
+        self.offset = None
+        # The SMTP connection
+        self.smtp = None
+        # {kind of error: number of consecutive errors}
+        self.errors = {}
+        # {email: number of failed attempts to send it}
+        self.attempts = {}
+        # Metrics
+        self.stats = {
+            'sent': 0,
+            'failed': 0,
+            'errors': 0,
+            'last_error': None,
+            'rate': 0.0}
+
+        failed = join(path, 'failed')
+        if not exists(failed):
+            makedirs(failed)
+
+
+    #######################################################################
+    # Queue
+    #######################################################################
+    def add(self, data):
+        """Add the given email (a byte string) to the queue, return its
+        name.
+        """
+        # Written to a temporary file first, not to send half an email
+        fd, tmp_path = mkstemp(suffix='.tmp', dir=self.path)
+        file = fdopen(fd, 'w')
+        try:
+            file.write(data)
+        finally:
+            file.close()
+        path = tmp_path[:-4]
+        rename(tmp_path, path)
+
+        # Index
+        name = basename(path)
+        with open(self.index, 'a') as file:
+            file.write('%s\n' % name)
+        return name
+
+
+    def push(self, name):
+        if name not in self.queued:
+            self.queue.append(name)
+            self.queued.add(name)
+
+
+    def pop(self):
+        name = self.queue.popleft()
+        self.queued.discard(name)
+        self.attempts.pop(name, None)
+        return name
+
+
+    def get_names(self):
+        """Return the names of the emails in the spool folder.
+        """
+        names = []
+        for name in listdir(self.path):
+            if (name in ('failed', self.stats_name)
+                or name.startswith(self.index_name)
+                or name.endswith(('.lock', '.tmp'))):
+                continue
+            names.append(name)
+        return names
+
+
+    def scan(self):
+        """Add to the queue the emails found in the spool folder.  Only done
+        when starting and when the index is emptied, for the emails not in
+        the index (added by an older version or by other tools).
+        """
+        names = self.get_names()
+        path = self.path
+        names.sort(key=lambda x: getmtime(join(path, x)))
+        for name in names:
+            self.push(name)
+
+
+    def read_index(self):
+        """Add to the queue the emails appended to the index since the last
+        call.
+        """
+        # Starting
+        if self.offset is None:
+            self.offset = getsize(self.index) if exists(self.index) else 0
+            self.scan()
+            return
+
+        if not exists(self.index):
+            return
+        with open(self.index) as file:
+            file.seek(self.offset)
+            data = file.read()
+        # Only the complete lines
+        n = data.rfind('\n') + 1
+        self.offset += n
+        for name in data[:n].split():
+            self.push(name)
+
+
+    def compact(self):
+        """Empty the index.
+        """
+        tmp_path = '%s.tmp' % self.index
+        rename(self.index, tmp_path)
+        with open(tmp_path) as file:
+            file.seek(self.offset)
+            data = file.read()
+        remove(tmp_path)
+        self.offset = 0
+        for name in data.split():
+            self.push(name)
+        # An email may have been added to the old index after we read it
+        self.scan()
+
+
+    def get_size(self):
+        self.read_index()
+        return len(self.queue)
+
+
+    #######################################################################
+    # SMTP
+    #######################################################################
+    def connect(self):
+        smtp = self.smtp
+        if smtp is not None:
+            # The connection may have timed out while we were waiting
+            try:
+                smtp.noop()
+            except (SMTPException, socket_error):
+                self.disconnect()
+            else:
+                return smtp
+
+        smtp = SMTP(self.smtp_host)
+        log_info('CONNECTED to %s' % self.smtp_host)
+        if self.smtp_login and self.smtp_password:
+            smtp.login(self.smtp_login, self.smtp_password)
+        self.smtp = smtp
+        return smtp
+
+
+    def disconnect(self):
+        smtp = self.smtp
+        if smtp is None:
+            return
+        self.smtp = None
+        try:
+            smtp.quit()
+        except (SMTPException, socket_error):
+            smtp.close()
+
+
+    def log_error(self):
+        summary = 'Error sending email\n'
+        details = format_exc()
+        log_error(summary + details)
+
+
+    def backoff(self, kind):
+        """Record an error of the given kind, return the number of seconds to
+        wait before trying again.
+        """
+        n = self.errors.get(kind, 0) + 1
+        self.errors[kind] = n
+        self.stats['errors'] += 1
+        self.stats['last_error'] = kind
+        return min(self.backoff_min * 2 ** (n - 1), self.backoff_max)
+
+
+    def move_to_failed(self, name, new_name):
+        self.pop()
+        rename(join(self.path, name), join(self.path, 'failed', new_name))
+        self.stats['failed'] += 1
+
+
+    def retry(self, name):
+        """Count a failed attempt to send the given email, the first of the
+        queue.  Put it at the end of the queue and return True, or move it to
+        the "failed" folder after 'attempts_max' attempts and return False.
+        """
+        attempts = self.attempts.get(name, 0) + 1
+        if attempts >= self.attempts_max:
+            self.move_to_failed(name, name)
+            return False
+        self.attempts[name] = attempts
+        self.queue.rotate(-1)
+        return True
+
+
+    def send(self):
+        """Send the next batch of emails.  Return the number of seconds to
+        wait before the next batch, or False if there is nothing left to
+        send.
+        """
+        self.read_index()
+        if not self.queue:
+            self.disconnect()
+            if self.offset > self.index_size_max:
+                self.compact()
+            if not self.queue:
+                return False
+
+        # 1. Connect
+        smtp_host = self.smtp_host
+        try:
+            smtp = self.connect()
+        except gaierror, excp:
+            log_warning('%s: "%s"' % (excp[1], smtp_host))
+            return self.backoff('connect')
+        except Exception:
+            self.log_error()
+            self.disconnect()
+            return self.backoff('connect')
+        self.errors.pop('connect', None)
+
+        # 2. Send
+        t0 = time()
+        sent = 0
+        blocked = set() # The emails locked or failing
+        time_max = self.time_max
+        for i in range(min(self.batch_size, len(self.queue))):
+            if time_max is not None and time() - t0 >= time_max:
+                break
+            name = self.queue[0]
+            path = join(self.path, name)
+            if exists('%s.lock' % path):
+                # Locked, try later
+                self.queue.rotate(-1)
+                blocked.add(name)
+                continue
+
+            try:
+                with open(path) as file:
+                    message = file.read()
+            except IOError:
+                # Removed by someone else
+                self.pop()
+                continue
+
+            headers = HeaderParser().parsestr(message)
+            subject = headers['subject']
+            from_addr = headers['from']
+            to_addr = headers['to']
+            try:
+                smtp.sendmail(from_addr, to_addr, message)
+            except SMTPRecipientsRefused:
+                # The recipient addresses has been refused
+                self.log_error()
+                self.move_to_failed(name, name)
+            except SMTPResponseException, excp:
+                code = excp.smtp_code
+                if 400 <= code < 500:
+                    # Temporary failure, try again later (the other emails
+                    # first)
+                    log_warning('SMTP error %s: "%s"' % (code, excp.smtp_error))
+                    self.retry(name)
+                    self.disconnect()
+                    return self.backoff(code)
+                # The SMTP server returns an error code
+                self.log_error()
+                self.move_to_failed(name, '%s_%s' % (code, name))
+            except (SMTPException, socket_error):
+                # Lost the connection (maybe because of this email)
+                self.log_error()
+                self.retry(name)
+                self.disconnect()
+                return self.backoff('connection')
+            except Exception:
+                self.log_error()
+                self.stats['errors'] += 1
+                if self.retry(name):
+                    blocked.add(name)
+            else:
+                self.pop()
+                remove(path)
+                sent += 1
+                self.errors.clear()
+                # Log
+                log_msg = 'Email "%s" sent from "%s" to "%s"'
+                log_info(log_msg % (subject, from_addr, to_addr))
+
+        # Metrics
+        self.stats['sent'] += sent
+        if sent:
+            self.stats['rate'] = sent / max(time() - t0, 0.001)
+
+        # Is there something left?
+        if not self.queue:
+            self.disconnect()
+            return False
+        # Only emails that cannot be sent now, wait
+        if blocked.issuperset(self.queue):
+            self.disconnect()
+            return self.backoff('blocked')
+        return 1
+
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['queued'] = len(self.queue)
+        return stats
+
+
+    def save_stats(self):
+        """Write the counters to the stats file, for the web server to read
+        them when the emails are sent by another process.
+        """
+        stats = self.get_stats()
+        stats['pid'] = getpid()
+        stats['time'] = int(time())
+        fd, tmp_path = mkstemp(suffix='.tmp', dir=self.path)
+        file = fdopen(fd, 'w')
+        try:
+            json.dump(stats, file)
+        finally:
+            file.close()
+        rename(tmp_path, join(self.path, self.stats_name))
+
+
+    def load_stats(self):
+        """Read the stats file written by the mail worker.
+        """
+        try:
+            with open(join(self.path, self.stats_name)) as file:
+                stats = json.load(file)
+        except (IOError, ValueError):
+            stats = dict(self.stats, pid=None, time=None)
+        # The emails added since the last update (our queue is not emptied
+        # by the worker)
+        stats['queued'] = len(self.get_names())
+        return stats
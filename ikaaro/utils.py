@@ -17,8 +17,13 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 # Import from the Standard Library
-from hashlib import sha1, sha256
+from calendar import timegm
+from collections import OrderedDict
+from hashlib import md5, sha1, sha256
+from os import listdir, makedirs, remove, rename, utime
+from os.path import exists, getmtime, getsize, join
 from random import sample
+from time import mktime, time
 
 # Import from other modules
 try:
@@ -29,7 +34,7 @@ except ImportError:
 # Import from itools
 from itools.database import AllQuery, AndQuery, PhraseQuery, OrQuery
 from itools.database import RangeQuery
-from itools.datatypes import Unicode
+from itools.datatypes import HTTPDate, Unicode
 from itools.handlers import checkid
 from itools.html import HTMLParser, stream_to_str_as_xhtml
 from itools.stl import STLTemplate, stl_namespaces
@@ -383,3 +388,171 @@ def close_fancybox(context, default=None):
     # Case 2: normal
     goto = context.get_form_value('referrer') or default
     return get_reference(goto) if type(goto) is str else goto
+
+
+
+###########################################################################
+# HTTP cache
+###########################################################################
+def get_etag(*args):
+    """Build an entity tag out of the given values (the key of a handler,
+    its modification time, etc.)
+    """
+    value = '\0'.join([ str(x) for x in args ])
+    return '"%s"' % md5(value).hexdigest()
+
+
+
+def _get_timestamp(value):
+    if value.tzinfo is None:
+        return int(mktime(value.timetuple()))
+    return timegm(value.utctimetuple())
+
+
+def is_not_modified(context, mtime, etag):
+    """Set the validators of the response (the ETag and Last-Modified
+    headers), and return True if the copy of the client is still valid,
+    as told by the If-None-Match and If-Modified-Since headers.
+    """
+    context.set_header('ETag', etag)
+    if mtime is not None:
+        context.set_header('Last-Modified', mtime)
+
+    # If-None-Match has priority over If-Modified-Since
+    if_none_match = context.get_header('If-None-Match')
+    if if_none_match:
+        tags = [ x.strip() for x in if_none_match.split(',') ]
+        return etag in tags or '*' in tags
+
+    since = context.get_header('If-Modified-Since')
+    if not since or mtime is None:
+        return False
+    if type(since) is str:
+        try:
+            since = HTTPDate.decode(since)
+        except Exception:
+            return False
+    return _get_timestamp(mtime) <= _get_timestamp(since)
+
+
+
+class DiskCache(object):
+    """A cache of byte strings, stored as files within the given folder.
+    When the total size of the files reaches 'size_max' bytes, the least
+    recently used entries are removed until a quarter of the space is free.
+    """
+
+    def __init__(self, path, size_max):
+        self.path = path
+        self.size_max = size_max
+        self.size = None
+
+
+    def get_path(self, key):
+        return join(self.path, md5(repr(key)).hexdigest())
+
+
+    def get(self, key):
+        path = self.get_path(key)
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except IOError:
+            return None
+        # Mark the entry as recently used
+        utime(path, None)
+        return data
+
+
+    def set(self, key, data):
+        if self.size is None:
+            if not exists(self.path):
+                makedirs(self.path)
+            self.size = sum([ getsize(x) for x in self.get_files() ])
+
+        # Write (atomic)
+        path = self.get_path(key)
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'wb') as file:
+            file.write(data)
+        rename(tmp_path, path)
+
+        # Make room
+        self.size += len(data)
+        if self.size > self.size_max:
+            self.make_room()
+
+
+    def get_files(self):
+        return [ join(self.path, x) for x in listdir(self.path) ]
+
+
+    def make_room(self):
+        files = [ (getmtime(x), getsize(x), x) for x in self.get_files() ]
+        files.sort()
+        size = sum([ x[1] for x in files ])
+        size_min = self.size_max * 3 / 4
+        for mtime, file_size, path in files:
+            if size <= size_min:
+                break
+            try:
+                remove(path)
+            except OSError:
+                pass
+            size -= file_size
+        self.size = size
+
+
+
+class PageCache(object):
+    """In-memory cache of the pages served to anonymous users, of at most
+    'size_max' bytes.  Pages expire after 'ttl' seconds, and the least
+    recently used pages are removed first when the cache is full.
+    """
+
+    def __init__(self, size_max, ttl):
+        self.size_max = size_max
+        self.ttl = ttl
+        # {key: (expires, content_type, data, headers)}
+        self.pages = OrderedDict()
+        self.size = 0
+
+
+    def get(self, key):
+        page = self.pages.pop(key, None)
+        if page is None:
+            return None
+
+        expires, content_type, data, headers = page
+        if expires < time():
+            self.size -= len(data)
+            return None
+
+        # Mark the page as recently used
+        self.pages[key] = page
+        return content_type, data, headers
+
+
+    def set(self, key, content_type, data, headers):
+        if len(data) > self.size_max:
+            return
+
+        page = self.pages.pop(key, None)
+        if page is not None:
+            self.size -= len(page[2])
+
+        # Make room
+        while self.size + len(data) > self.size_max:
+            kk, page = self.pages.popitem(last=False)
+            self.size -= len(page[2])
+
+        self.pages[key] = (time() + self.ttl, content_type, data, headers)
+        self.size += len(data)
+
+
+    def clear(self, paths=None):
+        """Remove every page.  Any change may appear on any page (menus,
+        footers, lists, etc.), so this is called for every commit.
+        """
+        self.pages.clear()
+        self.size = 0
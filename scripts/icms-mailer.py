@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from optparse import OptionParser
+from os import getpid, remove
+from signal import signal, SIGINT, SIGTERM
+from sys import exit
+from time import sleep, time
+
+# Import from itools
+from itools import __version__
+from itools.core import become_daemon
+from itools.fs import lfs
+from itools.log import Logger, register_logger, log_info
+
+# Import from ikaaro
+from ikaaro.server import get_config, get_pid, log_levels
+from ikaaro.spool import Spool
+
+
+# Seconds between two looks at the spool when there is nothing to send
+poll_interval = 1
+# Seconds between two updates of the stats file when nothing changes
+stats_interval = 60
+
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+
+
+if __name__ == '__main__':
+    # The command line parser
+    usage = '%prog [OPTIONS] TARGET'
+    version = 'itools %s' % __version__
+    description = (
+        'Sends the emails of the TARGET ikaaro instance, from its spool. The'
+        ' web server only adds the emails to the spool when the "mail-worker"'
+        ' option is set in its configuration file.')
+    parser = OptionParser(usage, version=version, description=description)
+    parser.add_option(
+        '-d', '--detach', action="store_true", default=False,
+        help="Detach from the console.")
+
+    # Parse arguments
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('Wrong number of arguments.')
+    target = lfs.get_absolute_path(args[0])
+
+    # Only one worker per instance, not to send the emails twice
+    pid_file = '%s/pid-mailer' % target
+    if get_pid(pid_file) is not None:
+        print '[%s] The mail worker is already running.' % target
+        exit(1)
+
+    # Configuration
+    config = get_config(target)
+    get_value = config.get_value
+    smtp_host = get_value('smtp-host')
+    if not smtp_host:
+        print '[%s] "smtp-host" is not set in config.conf' % target
+        exit(1)
+    if not get_value('mail-worker'):
+        print ('[%s] Warning: "mail-worker" is not set in config.conf, the'
+               ' web server sends the emails too.' % target)
+
+    # Logging
+    log_level = log_levels[get_value('log-level')]
+    register_logger(Logger('%s/log/mailer' % target, log_level), None)
+
+    # Daemon mode
+    if options.detach:
+        become_daemon()
+    with open(pid_file, 'w') as file:
+        file.write(str(getpid()))
+    signal(SIGTERM, stop)
+    signal(SIGINT, stop)
+
+    # Action!
+    spool = Spool('%s/spool' % target, smtp_host,
+                  get_value('smtp-login', default='').strip(),
+                  get_value('smtp-password', default='').strip(),
+                  get_value('smtp-batch-size'))
+    log_info('Mail worker started')
+    stats, stats_time = None, 0
+    try:
+        while True:
+            delay = spool.send()
+            # Stats
+            new_stats = spool.get_stats()
+            if new_stats != stats or time() - stats_time > stats_interval:
+                spool.save_stats()
+                stats, stats_time = new_stats, time()
+            sleep(delay or poll_interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        spool.disconnect()
+        remove(pid_file)
+    log_info('Mail worker stopped')
+    exit(0)
@@ -35,11 +35,19 @@ def update_catalog(parser, options, target):
     if ask_confirmation(message, options.confirm) is False:
         return
 
+    # Differential update
+    if options.since or options.incremental:
+        server.update_catalog(since=options.since, quiet=options.quiet)
+        return
+
     # Server reindex
     server.reindex_catalog(
         as_test=options.test,
         quiet=options.quiet,
-        quick=options.quick)
+        quick=options.quick,
+        processes=options.processes,
+        resume=options.resume,
+        shard_size=options.shard_size)
 
 
 
@@ -65,6 +73,20 @@ if __name__ == '__main__':
         help="do not check the database consistency.")
     parser.add_option('-t', '--test', action='store_true', default=False,
         help="a test mode, don't stop the indexation when an error occurs")
+    parser.add_option('--since', metavar='COMMIT',
+        help="only reindex the resources changed since the given commit")
+    parser.add_option('-i', '--incremental', action='store_true',
+        default=False,
+        help="only reindex the resources changed since the last commit the"
+             " catalog is known to be up-to-date with")
+    parser.add_option('-j', '--processes', type='int', default=1,
+        help="compute the catalog values with the given number of worker"
+             " processes (default 1)")
+    parser.add_option('--resume', action='store_true', default=False,
+        help="resume an interrupted update from its checkpoint")
+    parser.add_option('--shard-size', type='int', default=1000,
+        help="the maximum number of resources of the shards the tree is"
+             " split in for the workers (default 1000)")
 
     options, args = parser.parse_args()
     if len(args) != 1:
@@ -18,11 +18,13 @@
 from unittest import TestLoader, TestSuite, TextTestRunner
 
 # Import tests
+import test_database
 import test_metadata
 import test_server
+import test_spool
 
 
-test_modules = [test_metadata, test_server]
+test_modules = [test_database, test_metadata, test_server, test_spool]
 
 
 loader = TestLoader()
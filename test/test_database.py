@@ -0,0 +1,412 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from os import utime
+from time import time
+from unittest import TestCase, main
+
+# Import from itools
+from itools.fs import lfs
+
+# Import from ikaaro
+from ikaaro.database import LinksIndex, format_links_change, get_links_index
+from ikaaro.database import get_links_index_path, load_links_index
+from ikaaro.exceptions import ConsistencyError
+from ikaaro.folder import Folder, set_metadata_uuid
+from ikaaro.server import Server, create_server, get_fake_context
+from ikaaro.utils import DiskCache, get_etag
+from ikaaro.webpage import WebPage
+
+
+SERVER = None
+DATABASE_TEST_PATH = '/tmp/ikaaro-test-database'
+
+
+def get_server():
+    global SERVER
+    if SERVER is None:
+        path = DATABASE_TEST_PATH
+        if lfs.exists(path):
+            lfs.remove(path)
+        create_server(path, 'test@example.com', 'password', None, [], 8082)
+        SERVER = Server(path)
+    return SERVER
+
+
+def get_context(server):
+    context = get_fake_context(server.database, server.root.context_cls)
+    context.server = server
+    context.init_context()
+    context.set_mtime = True
+    return context
+
+
+
+class MetadataUUIDTestCase(TestCase):
+
+    def test_replace(self):
+        data = 'format:folder\ntitle;lang=en:Hi\n  more\nuuid:abc\n'
+        self.assertEqual(set_metadata_uuid(data, 'new'),
+                         'format:folder\ntitle;lang=en:Hi\n  more\nuuid:new\n')
+
+
+    def test_insert_sorted(self):
+        data = 'format:folder\ntitle:Hi\nversion:1\n'
+        self.assertEqual(set_metadata_uuid(data, 'new'),
+                         'format:folder\ntitle:Hi\nuuid:new\nversion:1\n')
+
+
+    def test_append(self):
+        data = 'format:folder\ntitle:Hi'
+        self.assertEqual(set_metadata_uuid(data, 'new'),
+                         'format:folder\ntitle:Hi\nuuid:new\n')
+
+
+
+class LinksIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.path = '/tmp/ikaaro-test-links.index'
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+        index = LinksIndex(self.path)
+        index.update([('/a', ['/b', '/c']), ('/b', ['/a']), ('/c', [])])
+        self.index = index
+
+
+    def tearDown(self):
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+
+
+    def test_update(self):
+        index = self.index
+        self.assertEqual(index.get_sources('/b'), set(['/a']))
+        self.assertEqual(index.orphans, set())
+        self.assertEqual(index.broken, set())
+        # Unindex a resource linked from another one
+        index.update([('/c', None), ('/b', ['/d'])])
+        self.assertEqual(index.get_sources('/c'), set(['/a']))
+        self.assertEqual(index.broken, set(['/c', '/d']))
+        self.assertEqual(index.get_broken_links('/a'), {'/a': ['/c']})
+
+
+    def test_save_and_load(self):
+        self.index.save()
+        index = LinksIndex(self.path)
+        self.assertEqual(index.load(), True)
+        self.assertEqual(index.sources, self.index.sources)
+        self.assertEqual(index.targets, self.index.targets)
+        self.assertEqual(index.orphans, self.index.orphans)
+
+
+    def test_load_journal(self):
+        self.index.save()
+        # The journal is compacted when it is too long
+        with open(self.path, 'a') as file:
+            for i in range(1500):
+                file.write(format_links_change('/c', ['/a']))
+                file.write(format_links_change('/c', None))
+        index = LinksIndex(self.path)
+        index.load(compact=True)
+        self.assertEqual(index.targets.get('/c'), None)
+        self.assertEqual(index.get_sources('/a'), set(['/b']))
+        with open(self.path) as file:
+            self.assertEqual(len(file.readlines()), 2)
+
+
+    def test_get_paths(self):
+        index = self.index
+        index.update([('/a/b', []), ('/a-b', []), ('/a/b/c', [])])
+        self.assertEqual(list(index.get_paths('/a')), ['/a', '/a/b', '/a/b/c'])
+        index.update([('/a/b', None)])
+        self.assertEqual(list(index.get_paths('/a/')), ['/a', '/a/b/c'])
+        self.assertEqual(list(index.get_paths('/d')), [])
+
+
+    def test_missing(self):
+        self.assertEqual(LinksIndex(self.path).load(), False)
+
+
+    def test_out_of_sync(self):
+        self.index.sha = 'a'
+        self.index.save()
+        # The catalog was committed, the index was not updated
+        self.assertEqual(LinksIndex(self.path).load('b'), False)
+        with open(self.path, 'a') as file:
+            file.write(format_links_change('/c', ['/a']))
+            file.write('=\tb\n')
+        index = LinksIndex(self.path)
+        self.assertEqual(index.load('b'), True)
+        self.assertEqual(index.get_sources('/a'), set(['/b', '/c']))
+
+
+
+class EtagDiskCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.path = '/tmp/ikaaro-test-cache'
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+
+
+    def tearDown(self):
+        if lfs.exists(self.path):
+            lfs.remove(self.path)
+
+
+    def test_etag(self):
+        self.assertEqual(get_etag('a', 1), get_etag('a', 1))
+        self.assertNotEqual(get_etag('a', 1), get_etag('a', 2))
+        self.assertEqual(get_etag('a')[0], '"')
+
+
+    def test_get_set(self):
+        cache = DiskCache(self.path, 1000)
+        self.assertEqual(cache.get(('a', 1)), None)
+        cache.set(('a', 1), 'data')
+        self.assertEqual(cache.get(('a', 1)), 'data')
+
+
+    def test_make_room(self):
+        cache = DiskCache(self.path, 100)
+        now = time()
+        # The least recently used entries are removed first
+        for i, key in enumerate(['a', 'b', 'c']):
+            cache.set(key, 'x' * 40)
+            path = cache.get_path(key)
+            if lfs.exists(path):
+                utime(path, (now - 100 + i, now - 100 + i))
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 'x' * 40)
+
+
+
+class NameTestCase(TestCase):
+
+    def setUp(self):
+        self.server = server = get_server()
+        self.context = get_context(server)
+        self.database = server.database
+
+
+    def test_make_resource_name(self):
+        database = self.database
+        root = database.get_resource('/')
+        folder = root.make_resource('names', Folder)
+        folder.make_resource(None, WebPage)
+        folder.make_resource(None, WebPage)
+        self.assertEqual(folder.get_value('last_auto_name'), 1)
+        # Explicit names are skipped
+        folder.make_resource('2', WebPage)
+        folder.make_resource(None, WebPage)
+        self.assertEqual(folder.get_value('last_auto_name'), 3)
+        self.assertEqual(sorted(folder.get_names()), ['0', '1', '2', '3'])
+        # Names are not given again once the resource is removed
+        folder.del_resource('3')
+        self.assertEqual(folder.make_resource_name(), '4')
+        root.del_resource('names')
+        database.save_changes()
+
+
+
+class DeleteTestCase(TestCase):
+
+    def setUp(self):
+        self.server = server = get_server()
+        self.context = get_context(server)
+        self.database = database = server.database
+        root = database.get_resource('/')
+        if root.get_resource('del-target', soft=True) is None:
+            folder = root.make_resource('del-target', Folder)
+            folder.make_resource('page', WebPage)
+            referrer = root.make_resource('del-referrer', WebPage)
+            referrer.set_value('share', ['/del-target/page'])
+            database.save_changes()
+
+
+    def tearDown(self):
+        self.database.abort_changes()
+
+
+    def test_links_index(self):
+        database = self.database
+        path = get_links_index_path(database)
+        if lfs.exists(path):
+            lfs.remove(path)
+        # Not written from the requests
+        database.links_index = None
+        index = get_links_index(database)
+        self.assertEqual(index.get_sources('/del-target/page'),
+                         set(['/del-referrer']))
+        self.assertEqual(lfs.exists(path), False)
+        # Built at start
+        index = load_links_index(database, save=True)
+        self.assertEqual(lfs.exists(path), True)
+        self.assertEqual(get_links_index(database), index)
+
+
+    def test_referenced(self):
+        root = self.database.get_resource('/')
+        self.assertRaises(ConsistencyError, root.del_resource, 'del-target')
+        self.assertRaises(ConsistencyError, root.del_resource,
+                          'del-target/page')
+
+
+    def test_referenced_from_inside(self):
+        root = self.database.get_resource('/')
+        folder = root.make_resource('del-inside', Folder)
+        folder.make_resource('a', WebPage)
+        referrer = folder.make_resource('b', WebPage)
+        referrer.set_value('share', ['/del-inside/a'])
+        self.database.save_changes()
+        root.del_resource('del-inside')
+        self.database.save_changes()
+
+
+    def test_link_removed(self):
+        root = self.database.get_resource('/')
+        referrer = root.get_resource('del-referrer')
+        referrer.set_value('share', [])
+        root.del_resource('del-target')
+        self.assertEqual(root.get_resource('del-target', soft=True), None)
+
+
+    def test_link_added(self):
+        root = self.database.get_resource('/')
+        root.make_resource('del-new-target', WebPage)
+        referrer = root.make_resource('del-new-referrer', WebPage)
+        referrer.set_value('share', ['/del-new-target'])
+        self.assertRaises(ConsistencyError, root.del_resource,
+                          'del-new-target')
+
+
+    def test_force(self):
+        root = self.database.get_resource('/')
+        root.del_resource('del-target', ref_action='force')
+        self.assertEqual(root.get_resource('del-target', soft=True), None)
+
+
+
+class RevisionsTestCase(TestCase):
+
+    def setUp(self):
+        self.server = server = get_server()
+        self.context = context = get_context(server)
+        self.database = database = server.database
+        root = database.get_resource('/')
+        if root.get_resource('revisions', soft=True) is None:
+            page = root.make_resource('revisions', WebPage)
+            for i in range(3):
+                page.set_value('title', u'Revision %d' % i, language='en')
+                context.git_message = u'revisions-test %d' % i
+                database.save_changes()
+            context.git_message = None
+
+
+    def get_shas(self, revisions):
+        return [ x['sha'] for x in revisions ]
+
+
+    def test_page(self):
+        page = self.database.get_resource('/revisions')
+        revisions = page.get_revisions()
+        total, items = page.get_revisions_page(0, 2)
+        self.assertEqual(total, len(revisions))
+        self.assertEqual(self.get_shas(items), self.get_shas(revisions[:2]))
+        total, items = page.get_revisions_page(2, 2)
+        self.assertEqual(self.get_shas(items), self.get_shas(revisions[2:4]))
+        self.assertEqual(items[0]['message_short'],
+                         revisions[2]['message_short'])
+
+
+    def test_filters(self):
+        page = self.database.get_resource('/revisions')
+        total, items = page.get_revisions_page(
+            grep_pattern='revisions-test 1')
+        self.assertEqual(total, 1)
+        self.assertEqual(items[0]['message_short'], 'revisions-test 1')
+        revisions = page.get_revisions(author_pattern='nobody')
+        total, items = page.get_revisions_page(author_pattern='nobody')
+        self.assertEqual(self.get_shas(items), self.get_shas(revisions))
+
+
+    def test_new_commit(self):
+        database = self.database
+        page = database.get_resource('/revisions')
+        total, items = page.get_revisions_page(0, 1)
+        page.set_value('title', u'Revision new', language='en')
+        database.save_changes()
+        new_total, new_items = page.get_revisions_page(0, 1)
+        self.assertEqual(new_total, total + 1)
+        self.assertNotEqual(new_items[0]['sha'], items[0]['sha'])
+
+
+
+class CopyTestCase(TestCase):
+
+    def setUp(self):
+        self.server = server = get_server()
+        self.context = get_context(server)
+        self.database = database = server.database
+        root = database.get_resource('/')
+        if root.get_resource('copy-source', soft=True) is None:
+            folder = root.make_resource('copy-source', Folder)
+            folder.make_resource('page', WebPage)
+            folder.make_resource('sub', Folder)
+            folder.make_resource('sub/page', WebPage)
+            database.save_changes()
+
+
+    def test_copy(self):
+        database = self.database
+        root = database.get_resource('/')
+        root.copy_resource('/copy-source', '/copy-target')
+        source = root.get_resource('copy-source/sub/page')
+        target = root.get_resource('copy-target/sub/page')
+        self.assertNotEqual(target.get_value('uuid'),
+                            source.get_value('uuid'))
+        database.save_changes()
+        self.assertEqual(len(database.search(abspath='/copy-target/sub/page')),
+                         1)
+        root.del_resource('copy-target')
+        database.save_changes()
+
+
+    def test_copy_and_abort(self):
+        database = self.database
+        root = database.get_resource('/')
+        root.copy_resource('/copy-source', '/copy-aborted')
+        # The copies are not in the cache (as after 'make_room')
+        for key in database.copied:
+            if key in database.cache:
+                database._discard_handler(key)
+        database.abort_changes()
+        self.assertEqual(database.added, set())
+        self.assertEqual(database.copied, set())
+        self.assertEqual(root.get_resource('copy-aborted', soft=True), None)
+        path = '%s/database/copy-aborted' % DATABASE_TEST_PATH
+        self.assertEqual(lfs.exists(path), False)
+        # The next transaction does not commit the copy
+        root.set_value('title', u'Copy aborted', language='en')
+        database.save_changes()
+        self.assertEqual(lfs.exists('%s.metadata' % path), False)
+
+
+
+if __name__ == '__main__':
+    main()
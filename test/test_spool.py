@@ -0,0 +1,156 @@
+# -*- coding: UTF-8 -*-
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Import from the Standard Library
+from os import listdir
+from smtplib import SMTPResponseException, SMTPServerDisconnected
+from unittest import TestCase, main
+
+# Import from itools
+from itools.fs import lfs
+
+# Import from ikaaro
+from ikaaro.spool import Spool
+
+
+SPOOL_TEST_PATH = '/tmp/ikaaro-test-spool'
+
+
+def make_email(to_addr):
+    return 'From: test@example.com\nTo: %s\nSubject: Test\n\nHello' % to_addr
+
+
+
+class SMTP(object):
+    """Stub of the SMTP connection: the emails to the addresses in 'errors'
+    fail with the given exception.
+    """
+
+    def __init__(self, errors=None):
+        self.errors = errors or {}
+        self.sent = []
+
+
+    def sendmail(self, from_addr, to_addr, message):
+        error = self.errors.get(to_addr)
+        if error is not None:
+            raise error
+        self.sent.append(to_addr)
+
+
+    def noop(self):
+        pass
+
+
+    def quit(self):
+        pass
+
+
+
+class SpoolTestCase(TestCase):
+
+    def setUp(self):
+        if lfs.exists(SPOOL_TEST_PATH):
+            lfs.remove(SPOOL_TEST_PATH)
+        lfs.make_folder(SPOOL_TEST_PATH)
+        self.spool = Spool(SPOOL_TEST_PATH, 'localhost')
+        self.spool.log_error = lambda: None
+
+
+    def tearDown(self):
+        if lfs.exists(SPOOL_TEST_PATH):
+            lfs.remove(SPOOL_TEST_PATH)
+
+
+    def connect(self, errors=None):
+        smtp = SMTP(errors)
+        self.spool.connect = lambda: smtp
+        return smtp
+
+
+    def test_send(self):
+        spool = self.spool
+        smtp = self.connect()
+        spool.add(make_email('a@example.com'))
+        spool.add(make_email('b@example.com'))
+        self.assertEqual(spool.get_size(), 2)
+        self.assertEqual(spool.send(), False)
+        self.assertEqual(smtp.sent, ['a@example.com', 'b@example.com'])
+        self.assertEqual(spool.get_names(), [])
+        self.assertEqual(spool.get_stats()['sent'], 2)
+
+
+    def test_broken_email(self):
+        spool = self.spool
+        smtp = self.connect({'a@example.com': ValueError('broken')})
+        spool.add(make_email('a@example.com'))
+        spool.add(make_email('b@example.com'))
+        # The other emails are sent, then wait
+        self.assertEqual(spool.send(), spool.backoff_min)
+        self.assertEqual(smtp.sent, ['b@example.com'])
+        # Give up
+        for i in range(spool.attempts_max - 1):
+            spool.send()
+        self.assertEqual(spool.get_size(), 0)
+        self.assertEqual(len(listdir('%s/failed' % SPOOL_TEST_PATH)), 1)
+        self.assertEqual(spool.get_stats()['failed'], 1)
+
+
+    def test_temporary_error(self):
+        spool = self.spool
+        error = SMTPResponseException(451, 'Try again later')
+        smtp = self.connect({'a@example.com': error})
+        spool.add(make_email('a@example.com'))
+        spool.add(make_email('b@example.com'))
+        # Wait, the email is retried after the others
+        self.assertEqual(spool.send(), spool.backoff_min)
+        self.assertEqual(smtp.sent, [])
+        self.assertEqual(spool.send(), spool.backoff_min)
+        self.assertEqual(smtp.sent, ['b@example.com'])
+        # The server accepts it at last
+        smtp.errors.clear()
+        self.assertEqual(spool.send(), False)
+        self.assertEqual(smtp.sent, ['b@example.com', 'a@example.com'])
+
+
+    def test_lost_connection(self):
+        spool = self.spool
+        error = SMTPServerDisconnected('Too big')
+        smtp = self.connect({'a@example.com': error})
+        spool.add(make_email('a@example.com'))
+        spool.add(make_email('b@example.com'))
+        self.assertEqual(spool.send(), spool.backoff_min)
+        # The next email does not wait behind it
+        spool.send()
+        self.assertEqual(smtp.sent, ['b@example.com'])
+        # Give up
+        for i in range(spool.attempts_max - 1):
+            spool.send()
+        self.assertEqual(spool.get_size(), 0)
+        self.assertEqual(spool.get_stats()['failed'], 1)
+
+
+    def test_time_max(self):
+        spool = self.spool
+        spool.time_max = 0
+        smtp = self.connect()
+        spool.add(make_email('a@example.com'))
+        self.assertEqual(spool.send(), 1)
+        self.assertEqual(smtp.sent, [])
+
+
+
+if __name__ == '__main__':
+    main()